@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
+
+import matplotlib
+matplotlib.use('Agg')   # headless, must be selected before plot_graphs imports pyplot
+
+from eyepos_heatmap import CumulativeHeatmaps
+from eyepos_io import load_eyepos
+from manifest import hash_inputs, load_manifest, save_manifest
+from figure_templates import HeatmapTemplate, SignalGraphTemplate
+from plot_graphs import (generate_eye_pos_heatmap, heatmap_filename, plot_graphs_for_trials,
+                         signal_graph_filename)
+from session_events import load_session_events
+from session_paths import run_paths
+
+MANIFEST_NAME = 'render-manifest.json'
+SIGNAL_GRAPH = 'signal'
+HEATMAP = 'heatmap'
+
+# per worker process: cache key -> (state of the input files when it was built, value)
+_events_cache = {}
+_heatmaps_cache = {}
+# figures are reused by every job of a worker process
+_signal_template = SignalGraphTemplate()
+_heatmap_template = HeatmapTemplate()
+
+
+class RenderJob:
+    """One output image: a graph type for one window of trials of one run."""
+
+    def __init__(self, kind, run_num, start_trial, end_trial, filepath_signal, filepath_eyepos, output_folder, params):
+        self.kind = kind
+        self.run_num = run_num
+        self.start_trial = start_trial
+        self.end_trial = end_trial
+        self.filepath_signal = filepath_signal
+        self.filepath_eyepos = filepath_eyepos
+        self.output_folder = output_folder
+        self.params = params
+
+    @property
+    def inputs(self):
+        if self.kind == SIGNAL_GRAPH:
+            return [self.filepath_signal, self.filepath_eyepos]
+        return [self.filepath_eyepos]
+
+    @property
+    def output_path(self):
+        if self.kind == SIGNAL_GRAPH:
+            name = signal_graph_filename(self.params['date'], self.run_num, self.start_trial, self.end_trial)
+        else:
+            name = heatmap_filename(self.params['date'], self.run_num, self.params['rad'], self.start_trial,
+                                    self.end_trial)
+        return os.path.join(self.output_folder, name)
+
+    def key(self, input_hashes):
+        """Content key of the job: everything that changes the image."""
+        description = {
+            'kind': self.kind,
+            'trials': [self.start_trial, self.end_trial],
+            'params': self.params,
+            'inputs': [input_hashes[path] for path in self.inputs],
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def __str__(self):
+        return "run {} {} trial {}-{}".format(self.run_num, self.kind, self.start_trial, self.end_trial)
+
+
+def enumerate_jobs(target_folder, date, first_run, last_run, first_trial, last_trial, tile_size, rad,
+                   signal_window=1, heatmap_window=2, fast=False):
+    """Lists the same images as plot_graphs.py's __main__: sliding windows of trials for every run."""
+    jobs = []
+    for run_num in range(first_run, last_run + 1):
+        filepath_signal, filepath_eyepos, output_folder = run_paths(target_folder, run_num)
+        for kind, window, params in [(SIGNAL_GRAPH, signal_window, {'date': date, 'fast': fast}),
+                                     (HEATMAP, heatmap_window, {'date': date, 'tile_size': tile_size, 'rad': rad})]:
+            for trial in range(first_trial, last_trial - window + 2):
+                jobs.append(RenderJob(kind, run_num, trial, trial + window - 1, filepath_signal, filepath_eyepos,
+                                      output_folder, params))
+    return jobs
+
+
+def is_up_to_date(job, key, manifest):
+    output_path = job.output_path
+    if manifest['outputs'].get(output_path) != key or not os.path.exists(output_path):
+        return False
+    output_mtime = os.stat(output_path).st_mtime_ns
+    return all(output_mtime >= os.stat(path).st_mtime_ns for path in job.inputs)
+
+
+def file_states(paths):
+    return tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in paths)
+
+
+def cached(cache, key, paths, build):
+    """
+    The value built from the given input files, rebuilt when any of them changed since it was cached.
+
+    A worker process of a long lived pool (see watch_session.py) outlives many versions of the same csv files.
+    """
+    state = file_states(paths)
+    entry = cache.get(key)
+    if entry is None or entry[0] != state:
+        entry = cache[key] = (state, build())
+    return entry[1]
+
+
+def render_job(job):
+    """Renders one job in a worker process. Returns (seconds, error) so one failure never stops the batch."""
+    start = time.perf_counter()
+    try:
+        os.makedirs(job.output_folder, exist_ok=True)
+        if job.kind == SIGNAL_GRAPH:
+            # a worker renders many windows of the same run, so signal.csv is parsed once per process
+            events = cached(_events_cache, (job.filepath_signal, job.filepath_eyepos), job.inputs,
+                            lambda: load_session_events(job.filepath_signal, job.filepath_eyepos))
+            plot_graphs_for_trials(events, job.params['date'], job.run_num, job.start_trial,
+                                   job.end_trial, job.output_folder, job.params['fast'],
+                                   _signal_template if job.params['fast'] else None)
+        else:
+            # likewise every trial of a run is binned once per process, whatever windows the process renders
+            heatmaps = cached(_heatmaps_cache, (job.filepath_eyepos, job.params['tile_size']), job.inputs,
+                              lambda: CumulativeHeatmaps(load_eyepos(job.filepath_eyepos), job.params['tile_size']))
+            generate_eye_pos_heatmap(job.filepath_eyepos, job.start_trial, job.end_trial, job.params['tile_size'],
+                                     job.params['rad'], job.params['date'], job.run_num, job.output_folder,
+                                     heatmaps, _heatmap_template)
+        return time.perf_counter() - start, None
+    except Exception:
+        return time.perf_counter() - start, traceback.format_exc()
+
+
+def render_batch(jobs, manifest_path, workers=None, force=False, executor=None):
+    """
+    Renders every job whose output is missing or stale on a process pool (executor, or a new one of workers).
+
+    Returns a list of (job, status, seconds, error) where status is 'skipped', 'done' or 'failed'.
+    """
+    manifest = load_manifest(manifest_path)
+    runs = {}
+    for job in jobs:
+        runs.setdefault((job.filepath_signal, job.filepath_eyepos), []).append(job)
+
+    report = []
+    pending = {}
+    for (_, filepath_eyepos), run_jobs in runs.items():
+        # a missing or unreadable csv fails the jobs of its own run only
+        try:
+            input_hashes = hash_inputs(sorted({path for job in run_jobs for path in job.inputs}), manifest)
+            run_report = []
+            run_pending = {}
+            for job in run_jobs:
+                key = job.key(input_hashes)
+                if not force and is_up_to_date(job, key, manifest):
+                    run_report.append((job, 'skipped', 0.0, None))
+                else:
+                    run_pending[job] = key
+            # build the eye_pos cache up front so workers never convert the same csv concurrently
+            if run_pending:
+                load_eyepos(filepath_eyepos)
+        except Exception:
+            error = traceback.format_exc()
+            for job in run_jobs:
+                manifest['outputs'].pop(job.output_path, None)
+                report.append((job, 'failed', 0.0, error))
+                print("{:>7} {:6.2f}s  {}".format('failed', 0.0, job))
+            continue
+        report += run_report
+        pending.update(run_pending)
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) if executor is None else nullcontext(executor) as pool:
+            futures = {pool.submit(render_job, job): job for job in pending}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    seconds, error = future.result()
+                except Exception:
+                    # the worker itself died (e.g. out of memory)
+                    seconds, error = 0.0, traceback.format_exc()
+                if error is None:
+                    manifest['outputs'][job.output_path] = pending[job]
+                    report.append((job, 'done', seconds, None))
+                else:
+                    manifest['outputs'].pop(job.output_path, None)
+                    report.append((job, 'failed', seconds, error))
+                print("{:>7} {:6.2f}s  {}".format(report[-1][1], seconds, job))
+    finally:
+        save_manifest(manifest_path, manifest)
+    return report
+
+
+def print_summary(report):
+    counts = {status: sum(1 for r in report if r[1] == status) for status in ('done', 'skipped', 'failed')}
+    busy = sum(r[2] for r in report)
+    print("{done} rendered, {skipped} up to date, {failed} failed ({:.1f}s of worker time)".format(busy, **counts))
+    for job, status, seconds, error in report:
+        if status == 'failed':
+            print("\nFAILED {}\n{}".format(job, error))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render the signal graphs and heatmaps of a session in parallel, "
+                                                 "skipping images whose inputs have not changed.")
+    parser.add_argument('target_folder', help="the session folder that contains the csv folder and output folders")
+    parser.add_argument('date', help="date of the session, e.g. 2025-07-10")
+    parser.add_argument('--runs', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--trials', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--tile-size', type=float, default=0.1, help="the tile size in the heatmap")
+    parser.add_argument('--rad', type=float, default=0.8, help="fixation radius, the dotted circle in the heatmap")
+    parser.add_argument('--signal-window', type=int, default=1, help="trials per signal graph")
+    parser.add_argument('--heatmap-window', type=int, default=2, help="trials per heatmap")
+    parser.add_argument('--fast', action='store_true', help="fast rendering mode for the signal graphs")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--force', action='store_true', help="render everything, even up to date images")
+    args = parser.parse_args()
+
+    batch_jobs = enumerate_jobs(args.target_folder, args.date, args.runs[0], args.runs[1], args.trials[0],
+                                args.trials[1], args.tile_size, args.rad, args.signal_window, args.heatmap_window,
+                                args.fast)
+    batch_report = render_batch(batch_jobs, os.path.join(args.target_folder, MANIFEST_NAME), args.workers, args.force)
+    print_summary(batch_report)
+    if any(status == 'failed' for _, status, _, _ in batch_report):
+        raise SystemExit(1)
@@ -0,0 +1,245 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+
+import matplotlib
+matplotlib.use('Agg')   # headless, must be selected before plot_graphs imports pyplot
+
+import numpy as np
+import pandas as pd
+
+from eyepos_heatmap import CumulativeHeatmaps
+from eyepos_io import cache_paths, load_eyepos
+from figure_templates import HeatmapTemplate
+import instrumentation
+from instrumentation import peak_rss_mb, reset_peak_rss
+from plot_graphs import generate_eye_pos_heatmap, plot_graphs_for_trials
+from session_events import load_session_events
+from session_paths import run_paths
+from synthetic_session import generate_run
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+ENTRY_POINTS = ['plot_graphs_for_trials', 'generate_eye_pos_heatmap', 'generate_eyepos_magnitude_censor_1Dfile']
+
+
+def load_threshold_checker():
+    # the file name has a dash, so it cannot be imported by name
+    spec = importlib.util.spec_from_file_location('eyepos_threshold_checker',
+                                                  os.path.join(SCRIPT_FOLDER, 'eyepos-threshold-checker.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StageRecorder:
+    """
+    Wall time and peak RSS of named stages of one entry point.
+
+    Stages are also instrumentation stages ('benchmark/<name>'), so the peak RSS of the stages inside the scripts
+    and of these ones are tracked together.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        with instrumentation.stage('benchmark/' + name) as stage:
+            yield
+        self.stages.append({'name': name, 'wall_s': time.perf_counter() - start, 'peak_rss_mb': stage.peak})
+
+
+def remove_eyepos_cache(filepath_eyepos):
+    for path in cache_paths(filepath_eyepos):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def bench_plot_graphs(recorder, filepath_signal, filepath_eyepos, output_folder, n_trials):
+    with recorder.stage('load'):
+        events = load_session_events(filepath_signal, filepath_eyepos)
+    with recorder.stage('render 1 trial x3'):
+        for trial in range(1, min(n_trials, 3) + 1):
+            plot_graphs_for_trials(events, 'bench', 1, trial, trial, output_folder)
+    with recorder.stage('render {} trials'.format(min(n_trials, 5))):
+        plot_graphs_for_trials(events, 'bench', 1, 1, min(n_trials, 5), output_folder)
+    with recorder.stage('render 1 trial x3 fast'):
+        for trial in range(1, min(n_trials, 3) + 1):
+            plot_graphs_for_trials(events, 'bench', 1, trial, trial, output_folder, fast=True)
+
+
+def bench_heatmap(recorder, filepath_signal, filepath_eyepos, output_folder, n_trials, tile_size=0.1, rad=0.8):
+    with recorder.stage('load'):
+        eye_pos = load_eyepos(filepath_eyepos)
+    with recorder.stage('bin'):
+        heatmaps = CumulativeHeatmaps(eye_pos, tile_size)
+    with recorder.stage('render all 2 trial windows'):
+        template = HeatmapTemplate()
+        for trial in range(1, n_trials):
+            generate_eye_pos_heatmap(filepath_eyepos, trial, trial + 1, tile_size, rad, 'bench', 1, output_folder,
+                                     heatmaps, template)
+    with recorder.stage('render whole run uncached'):
+        generate_eye_pos_heatmap(filepath_eyepos, 1, n_trials, tile_size, rad, 'bench', 1, output_folder)
+
+
+def bench_censor(recorder, filepath_signal, filepath_eyepos, output_folder, n_trials):
+    checker = load_threshold_checker()
+    output = os.path.join(output_folder, 'bench.1D')
+    with recorder.stage('percentage'):
+        checker.generate_eyepos_magnitude_censor_1Dfile(filepath_eyepos, output, 1, n_trials, 'percentage',
+                                                        fixation=1.0, percent_threshold=0.8)
+    with recorder.stage('mean'):
+        checker.generate_eyepos_magnitude_censor_1Dfile(filepath_eyepos, output, 1, n_trials, 'mean',
+                                                        mean_threshold=1.0, std_dev_threshold=0.5)
+    with recorder.stage('percentage without cache'):
+        checker.generate_eyepos_magnitude_censor_1Dfile(filepath_eyepos, output, 1, n_trials, 'percentage',
+                                                        fixation=1.0, percent_threshold=0.8, use_cache=False)
+
+
+BENCHMARKS = {
+    'plot_graphs_for_trials': bench_plot_graphs,
+    'generate_eye_pos_heatmap': bench_heatmap,
+    'generate_eyepos_magnitude_censor_1Dfile': bench_censor,
+}
+
+
+def run_entry_point(entry_point, target_folder, n_trials):
+    """
+    Runs one entry point in a fresh process, from a cold eye_pos cache. Returns its result dict.
+
+    Besides the stages of the benchmark itself, the result holds the instrumentation report of the call, i.e. the
+    load / index / compute / render / save stages inside the scripts.
+    """
+    filepath_signal, filepath_eyepos, output_folder = run_paths(target_folder, 1)
+    os.makedirs(output_folder, exist_ok=True)
+    remove_eyepos_cache(filepath_eyepos)
+
+    recorder = StageRecorder()
+    reset_peak_rss()
+    rss_before = peak_rss_mb()
+    instrumentation.enable()
+    instrumentation.begin_run(entry_point, trials=n_trials)
+    start = time.perf_counter()
+    BENCHMARKS[entry_point](recorder, filepath_signal, filepath_eyepos, output_folder, n_trials)
+    wall = time.perf_counter() - start
+    report = instrumentation.end_run(os.path.join(output_folder, '{}.{}'.format(entry_point,
+                                                                                 instrumentation.REPORT_NAME)))
+    return {'entry_point': entry_point, 'wall_s': wall, 'rss_before_mb': rss_before,
+            'peak_rss_mb': max(stage['peak_rss_mb'] for stage in recorder.stages), 'stages': recorder.stages,
+            'categories': report['categories'], 'instrumented_stages': report['stages']}
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_FOLDER, capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'pandas': pd.__version__, 'matplotlib': matplotlib.__version__,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run_benchmarks(sizes, trial_ms=12000, sample_rate=1000, entry_points=ENTRY_POINTS, repeat=1, data_folder=None):
+    """
+    Benchmarks every entry point at every size (number of trials of the synthetic run).
+
+    Every measurement runs in its own spawned process, so peak memory is not inflated by earlier ones.
+    The fastest of repeat runs is kept.
+    """
+    results = []
+    root = data_folder or tempfile.mkdtemp(prefix='fmri-bench-')
+    try:
+        for n_trials in sizes:
+            target_folder = os.path.join(root, 'bench{}'.format(n_trials))
+            os.makedirs(os.path.join(target_folder, 'csv'), exist_ok=True)
+            filepath_signal, filepath_eyepos, _ = run_paths(target_folder, 1)
+            generate_run(filepath_signal, filepath_eyepos, n_trials, trial_ms, sample_rate)
+            size = {'trials': n_trials, 'trial_ms': trial_ms, 'sample_rate': sample_rate,
+                    'eyepos_csv_mb': os.path.getsize(filepath_eyepos) / 1e6}
+
+            for entry_point in entry_points:
+                runs = []
+                for _ in range(repeat):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                        runs.append(executor.submit(run_entry_point, entry_point, target_folder, n_trials).result())
+                result = min(runs, key=lambda r: r['wall_s'])
+                result['size'] = size
+                results.append(result)
+                print("{:>4} trials  {:<42} {:7.2f}s  peak {:7.1f} MB".format(
+                    n_trials, entry_point, result['wall_s'], result['peak_rss_mb']))
+                for stage in result['stages']:
+                    print("            {:<42} {:7.2f}s  peak {:7.1f} MB".format(stage['name'], stage['wall_s'],
+                                                                               stage['peak_rss_mb']))
+    finally:
+        if data_folder is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance, min_seconds=0.05, min_mb=10):
+    """
+    Prints the change of every entry point and stage against an older report; returns the regressions.
+
+    A change counts when it is above tolerance (relative) and above min_seconds / min_mb, so timer noise on
+    very short stages is not reported.
+    """
+    old = {(r['size']['trials'], r['entry_point']): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = old.get((result['size']['trials'], result['entry_point']))
+        if previous is None:
+            continue
+        old_stages = {stage['name']: stage for stage in previous['stages']}
+        rows = [(result['entry_point'], previous, result)]
+        rows += [('  ' + stage['name'], old_stages[stage['name']], stage) for stage in result['stages']
+                 if stage['name'] in old_stages]
+        for name, before, after in rows:
+            ratio = after['wall_s'] / max(before['wall_s'], 1e-9)
+            flag = ''
+            slower = ratio > 1 + tolerance and after['wall_s'] - before['wall_s'] > min_seconds
+            larger = (after['peak_rss_mb'] > (1 + tolerance) * before['peak_rss_mb']
+                      and after['peak_rss_mb'] - before['peak_rss_mb'] > min_mb)
+            if slower or larger:
+                flag = '  REGRESSION'
+                regressions.append((result['size']['trials'], name.strip()))
+            print("{:>4} trials  {:<42} {:7.2f}s -> {:7.2f}s ({:5.2f}x)  {:7.1f} -> {:7.1f} MB{}".format(
+                result['size']['trials'], name, before['wall_s'], after['wall_s'], ratio, before['peak_rss_mb'],
+                after['peak_rss_mb'], flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the plotting and censoring entry points on synthetic runs.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 20, 60], help="trials per synthetic run")
+    parser.add_argument('--trial-ms', type=float, default=12000, help="mean length of a trial record in ms")
+    parser.add_argument('--sample-rate', type=float, default=1000, help="eye position sample rate in Hz")
+    parser.add_argument('--entry-points', nargs='+', choices=ENTRY_POINTS, default=ENTRY_POINTS)
+    parser.add_argument('--repeat', type=int, default=1, help="runs per measurement, the fastest is kept")
+    parser.add_argument('--data-folder', default=None, help="keep the synthetic sessions here (default: temporary)")
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', default=None, help="an older report; exits with 1 if anything got slower")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown / memory growth, 0.2 = 20%%")
+    args = parser.parse_args()
+
+    report = {'environment': environment(),
+              'results': run_benchmarks(args.sizes, args.trial_ms, args.sample_rate, args.entry_points, args.repeat,
+                                        args.data_folder)}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("written to {}".format(args.output))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            if compare(report['results'], json.load(f), args.tolerance):
+                raise SystemExit(1)
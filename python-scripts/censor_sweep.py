@@ -0,0 +1,166 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from eyepos_censor import TR_SAMPLES, compute_tr_stats, load_magnitude_block, write_censor_1Dfile
+from eyepos_io import load_eyepos
+from instrumentation import stage
+from session_paths import run_paths
+
+PARAMETERS = {'percentage': ('fixation', 'percent_threshold'), 'mean': ('mean_threshold', 'std_dev_threshold')}
+
+
+def fixation_counts(block, fixations):
+    """
+    Number of samples below every fixation radius, per TR, shape (trials, TRs, len(fixations)).
+
+    Each sample is put in the bin of the first radius it is below, so one pass over the block (a searchsorted and
+    a bincount) gives the counts of every radius at once.
+    """
+    n_trials, padded_rows = block.shape
+    n_trs = padded_rows // TR_SAMPLES
+    fixations = np.asarray(fixations, dtype=np.float64)
+    order = np.argsort(fixations)
+    n_bins = len(fixations) + 1
+
+    # x < fixations[j] for every j >= bin; NaN samples get the last bin, so they are never counted
+    bins = np.searchsorted(fixations[order], block, side='right').reshape(n_trials * n_trs, TR_SAMPLES)
+    bins += (np.arange(n_trials * n_trs) * n_bins)[:, None]
+    histogram = np.bincount(bins.ravel(), minlength=n_trials * n_trs * n_bins).reshape(n_trials, n_trs, n_bins)
+
+    counts = np.empty((n_trials, n_trs, len(fixations)), dtype=np.int64)
+    counts[..., order] = np.cumsum(histogram[..., :-1], axis=2)
+    return counts
+
+
+def sweep_trials(block, method, values_a, values_b):
+    """
+    Censor decisions of every parameter pair, shape (trials, TRs, len(values_a), len(values_b)); True keeps the TR.
+
+    values_a / values_b are fixation / percent_threshold for 'percentage' and mean_threshold / std_dev_threshold for
+    'mean'. Every decision is the same as censor_trials with that pair.
+    """
+    values_a = np.asarray(values_a, dtype=np.float64)
+    values_b = np.asarray(values_b, dtype=np.float64)
+    if method == 'mean':
+        mean, std = compute_tr_stats(block)
+        # NaN statistics compare False, so the TR is censored, as in censor_trials
+        return (mean[..., None] < values_a)[..., None] & (std[..., None] < values_b)[..., None, :]
+    elif method == 'percentage':
+        # the rate is always over a full TR, even for the last partial one
+        good_rate = fixation_counts(block, values_a) / TR_SAMPLES
+        return good_rate[..., None] > values_b
+    else:
+        raise Exception("Invalid method!")
+
+
+def sweep_run(filepath_eyepos, method, values_a, values_b, start_trial=None, end_trial=None):
+    """Returns (trials, number of TRs per trial, decisions) of one run, see sweep_trials."""
+    eye_pos = load_eyepos(filepath_eyepos)
+    trials = [trial for trial in eye_pos.trials if (start_trial is None or trial >= start_trial)
+              and (end_trial is None or trial <= end_trial)]
+    with stage('index/magnitude block'):
+        block, lengths = load_magnitude_block(eye_pos, trials)
+    with stage('compute/censor sweep'):
+        decisions = sweep_trials(block, method, values_a, values_b)
+    return trials, -(-lengths // TR_SAMPLES), decisions
+
+
+def censored_table(run_num, trials, n_trs, decisions, names, values_a, values_b):
+    """Censored TRs of every trial and of the whole run for every parameter pair, one row each."""
+    valid = np.arange(decisions.shape[1]) < n_trs[:, None]
+    censored = ((~decisions) & valid[..., None, None]).sum(axis=1)    # (trials, a, b)
+    counts = np.concatenate([censored, censored.sum(axis=0, keepdims=True)])
+    totals = np.append(n_trs, n_trs.sum())
+
+    a, b = np.meshgrid(values_a, values_b, indexing='ij')
+    rows = len(trials) + 1
+    table = pd.DataFrame({
+        'run': run_num,
+        'trial': np.repeat(np.array(list(trials) + ['all'], dtype=object), a.size),
+        names[0]: np.tile(a.ravel(), rows),
+        names[1]: np.tile(b.ravel(), rows),
+        'trs': np.repeat(totals, a.size),
+        'censored_trs': counts.reshape(-1),
+    })
+    with np.errstate(invalid='ignore'):
+        table['censored_fraction'] = table['censored_trs'] / table['trs']
+    return table
+
+
+def write_sweep_1Dfiles(output_folder, prefix, method, trials, n_trs, decisions, values_a, values_b):
+    """Writes one censor 1D file per parameter pair, named <prefix>-<method>-<a>-<b>.1D."""
+    os.makedirs(output_folder, exist_ok=True)
+    for i, a in enumerate(values_a):
+        for j, b in enumerate(values_b):
+            output = os.path.join(output_folder, "{}-{}-{:g}-{:g}.1D".format(prefix, method, a, b))
+            write_censor_1Dfile(output, [decisions[k, :n_trs[k], i, j].astype(int) for k in range(len(trials))])
+
+
+def sweep_session(target_folder, first_run, last_run, method, values_a, values_b, start_trial=None, end_trial=None,
+                  output_1D_folder=None):
+    """
+    Sweeps a grid of censor parameters over every run of a session and returns the table of censored TRs.
+
+    Every run is read and reduced to its per-TR statistics once, whatever the size of the grid. Rows with run
+    'all' are the totals of the session. With output_1D_folder, the 1D file of every run and pair is written too.
+    """
+    if method not in PARAMETERS:
+        raise Exception("Invalid method!")
+    names = PARAMETERS[method]
+    values_a = np.asarray(values_a, dtype=np.float64)
+    values_b = np.asarray(values_b, dtype=np.float64)
+
+    tables = []
+    for run_num in range(first_run, last_run + 1):
+        _, filepath_eyepos, _ = run_paths(target_folder, run_num)
+        trials, n_trs, decisions = sweep_run(filepath_eyepos, method, values_a, values_b, start_trial, end_trial)
+        tables.append(censored_table(run_num, trials, n_trs, decisions, names, values_a, values_b))
+        if output_1D_folder is not None:
+            with stage('save/1D file'):
+                prefix = os.path.splitext(os.path.basename(filepath_eyepos))[0]
+                write_sweep_1Dfiles(output_1D_folder, prefix, method, trials, n_trs, decisions, values_a, values_b)
+
+    table = pd.concat(tables, ignore_index=True)
+    runs = table[table['trial'] == 'all']
+    session = runs.groupby(list(names), sort=False, as_index=False)[['trs', 'censored_trs']].sum()
+    session.insert(0, 'run', 'all')
+    session.insert(1, 'trial', 'all')
+    session['censored_fraction'] = session['censored_trs'] / session['trs']
+    return pd.concat([table, session], ignore_index=True)
+
+
+def grid(start, stop, num):
+    return np.linspace(start, stop, int(num))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Censored TRs of a session for a whole grid of censor parameters.")
+    parser.add_argument('target_folder', help="the session folder that contains the csv folder")
+    parser.add_argument('--runs', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--trials', type=int, nargs=2, default=(None, None), metavar=('FIRST', 'LAST'),
+                        help="only these trials (default: the whole run)")
+    parser.add_argument('--method', choices=['mean', 'percentage'], required=True)
+    for name in ('fixation', 'percent-threshold', 'mean-threshold', 'std-dev-threshold'):
+        parser.add_argument('--' + name, type=float, nargs=3, metavar=('START', 'STOP', 'NUM'),
+                            help="NUM values from START to STOP")
+    parser.add_argument('--output', default=None,
+                        help="the table (default: <target_folder>/<session>-censor-sweep-<method>.csv)")
+    parser.add_argument('--write-1D', default=None, metavar='FOLDER', help="also write every 1D file to this folder")
+    args = parser.parse_args()
+
+    ranges = [getattr(args, name) for name in PARAMETERS[args.method]]
+    if None in ranges:
+        parser.error("--{} and --{} are required for {}".format(*[name.replace('_', '-') for name in
+                                                                   PARAMETERS[args.method]], args.method))
+    sweep = sweep_session(args.target_folder, args.runs[0], args.runs[1], args.method, grid(*ranges[0]),
+                          grid(*ranges[1]), args.trials[0], args.trials[1], args.write_1D)
+
+    session_name = os.path.basename(os.path.normpath(args.target_folder))
+    output = args.output or os.path.join(args.target_folder, "{}-censor-sweep-{}.csv".format(session_name,
+                                                                                          args.method))
+    with stage('save/sweep table'):
+        sweep.to_csv(output, index=False, float_format='%.6g')
+    print("written to {}".format(output))
@@ -0,0 +1,64 @@
+import numpy as np
+
+TR_SAMPLES = 1250   # samples per TR (TR1250 runs, eye position sampled at 1 kHz)
+
+
+def load_magnitude_block(eye_pos, trials):
+    """Returns (block, lengths) where block has one NaN padded row per trial, padded to a whole number of TRs.
+
+    Each trial is copied once into the block, because the per-TR reshape needs rows of the same length. The block is
+    float64 so the statistics are computed at the same precision as the old pandas code.
+    """
+    lengths = eye_pos.trial_lengths(trials)
+
+    padded_rows = -(-int(lengths.max(initial=0)) // TR_SAMPLES) * TR_SAMPLES
+    block = np.full((len(trials), padded_rows), np.nan)
+    for i, trial in enumerate(trials):
+        block[i, :lengths[i]] = eye_pos.magnitude(trial)
+    return block, lengths
+
+
+def compute_tr_stats(block):
+    """Computes the mean and std (ddof=1, NaN skipped, like pandas) of every TR of every trial in one pass."""
+    n_trials, padded_rows = block.shape
+    trs = block.reshape(n_trials, padded_rows // TR_SAMPLES, TR_SAMPLES)   # a view, no copy
+
+    valid = ~np.isnan(trs)
+    count = valid.sum(axis=2)
+    values = np.where(valid, trs, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = values.sum(axis=2) / count
+        deviation = np.where(valid, trs - mean[..., None], 0.0)
+        std = np.sqrt((deviation ** 2).sum(axis=2) / (count - 1))
+    return mean, std
+
+
+def censor_trials(block, lengths, method, mean_threshold=None, std_dev_threshold=None, fixation=None,
+                  percent_threshold=None):
+    """Returns one array of 0/1 censor values per trial, one value per (possibly partial) TR."""
+    if method == 'mean':
+        if mean_threshold is None or std_dev_threshold is None:
+            raise Exception("mean_threshold or std_dev_threshold cannot be empty!")
+        mean, std = compute_tr_stats(block)
+        # NaN statistics (empty or single sample TR) compare False, so the TR is censored
+        decision = (mean < mean_threshold) & (std < std_dev_threshold)
+    elif method == 'percentage':
+        if fixation is None or percent_threshold is None:
+            raise Exception("Fixation or percent_threshold cannot be empty!")
+        n_trials, padded_rows = block.shape
+        trs = block.reshape(n_trials, padded_rows // TR_SAMPLES, TR_SAMPLES)
+        # the rate is always over a full TR, even for the last partial one
+        good_rate = (trs < fixation).sum(axis=2) / TR_SAMPLES
+        decision = good_rate > percent_threshold
+    else:
+        raise Exception("Invalid method!")
+
+    n_trs = -(-lengths // TR_SAMPLES)
+    return [decision[i, :n_trs[i]].astype(int) for i in range(len(lengths))]
+
+
+def write_censor_1Dfile(output, censor_list):
+    with open(output, "w") as f:
+        for l in censor_list:
+            f.write("\n".join(map(str, l)))
+            f.write("\n")
@@ -0,0 +1,54 @@
+import numpy as np
+
+from instrumentation import instrumented
+
+HEATMAP_LIMIT = 3.5     # the heatmap covers -3.5 to 3.5 degrees on both axes
+
+
+def heatmap_edges(bin_size, limit=HEATMAP_LIMIT):
+    return np.arange(-limit, limit + bin_size, bin_size)
+
+
+def trial_histogram(x_coord, y_coord, edges, limit=HEATMAP_LIMIT):
+    """
+    2D histogram of one trial on the fixed grid, as integer counts indexed [x_bin, y_bin].
+
+    Coordinates are clipped to [-limit, limit] on both sides, so samples outside the grid land in the border tiles.
+    NaN samples are not counted.
+    """
+    n_bins = len(edges) - 1
+    valid = ~(np.isnan(x_coord) | np.isnan(y_coord))
+    x_bin = np.searchsorted(edges, np.clip(x_coord[valid], -limit, limit), side='right') - 1
+    y_bin = np.searchsorted(edges, np.clip(y_coord[valid], -limit, limit), side='right') - 1
+    np.clip(x_bin, 0, n_bins - 1, out=x_bin)
+    np.clip(y_bin, 0, n_bins - 1, out=y_bin)
+    return np.bincount(x_bin * n_bins + y_bin, minlength=n_bins * n_bins).reshape(n_bins, n_bins)
+
+
+class CumulativeHeatmaps:
+    """
+    Running sum of the per-trial histograms of a run.
+
+    Every trial is binned once; the histogram of any range of trials is the difference of two cumulative grids.
+    """
+
+    @instrumented('compute/cumulative heatmaps')
+    def __init__(self, eye_pos, bin_size, limit=HEATMAP_LIMIT):
+        self.bin_size = bin_size
+        self.edges = heatmap_edges(bin_size, limit)
+        self.trials = list(eye_pos.trials)
+        self._position = {trial: i for i, trial in enumerate(self.trials)}
+
+        n_bins = len(self.edges) - 1
+        self.counts = np.zeros((len(self.trials) + 1, n_bins, n_bins), dtype=np.int64)
+        for i, trial in enumerate(self.trials):
+            self.counts[i + 1] = self.counts[i] + trial_histogram(eye_pos.xcoord(trial), eye_pos.ycoord(trial),
+                                                                  self.edges, limit)
+        # samples per trial (NaN included), the denominator of the percentages
+        self.samples = np.concatenate([[0], np.cumsum(eye_pos.lengths)])
+
+    def histogram(self, start_trial, end_trial):
+        """Returns (counts, total samples) for trials start_trial to end_trial inclusive."""
+        start = self._position[start_trial]
+        end = self._position[end_trial] + 1
+        return self.counts[end] - self.counts[start], int(self.samples[end] - self.samples[start])
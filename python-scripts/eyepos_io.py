@@ -0,0 +1,273 @@
+import json
+import math
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stage
+from manifest import file_hash
+
+QUANTITIES = ('xcoord', 'ycoord', 'magnitude')
+CACHE_VERSION = 1
+CHUNK_ROWS = 20000      # rows per chunk when streaming a csv; bounds peak memory independently of the file length
+COLUMN_PATTERN = re.compile(r'eye_pos(\d+)_(xcoord|ycoord|magnitude)$')
+
+
+class EyePosRun:
+    """
+    One run of eye positions stored as ragged per-trial float32 arrays.
+
+    data has one row per quantity (xcoord, ycoord, magnitude by default); the samples of trial k are
+    data[:, offsets[i]:offsets[i] + lengths[i]] where i is the position of k in trials.
+    Every accessor returns a view, so a memory-mapped cache is only paged in where it is read.
+
+    The offline time of sample j of trial k (the time axis of AbsCodeTime at 1 kHz) is offsets[i] + j, i.e. the
+    position of the sample in data, so time is one shared axis and the time of any trial is a view of it too.
+    This only holds when data has every trial of the run (complete); otherwise time raises instead of being wrong.
+    """
+
+    def __init__(self, data, trials, lengths, quantities=QUANTITIES, complete=True):
+        self.data = data
+        self.complete = complete
+        self.quantities = tuple(quantities)
+        self.trials = [int(trial) for trial in trials]
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+        self._position = {trial: i for i, trial in enumerate(self.trials)}
+        self._time = None
+
+    @property
+    def time(self):
+        """Offline time of every sample, built once per run."""
+        self.check_time()
+        if self._time is None:
+            self._time = np.arange(self.offsets[-1], dtype=np.int64)
+        return self._time
+
+    def check_time(self):
+        if not self.complete:
+            raise Exception("Only some trials of the run were read, so the offline time of the samples is unknown! "
+                            "Load every trial (e.g. with load_eyepos) to line them up with AbsCodeTime.")
+
+    def positions(self, trials):
+        return np.array([self._position[trial] for trial in trials], dtype=np.int64)
+
+    def trial_lengths(self, trials):
+        return self.lengths[self.positions(trials)]
+
+    def samples(self, trial, start_time=None):
+        """
+        Slice of the samples of a trial in data and time, from the first one at or after start_time if given
+        (the same samples as time >= start_time, without building the mask). A NaN start_time selects none.
+        """
+        i = self._position[trial]
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        if start_time is not None:
+            self.check_time()
+            start = end if np.isnan(start_time) else min(max(start, math.ceil(start_time)), end)
+        return slice(start, end)
+
+    def values(self, quantity, samples):
+        """One quantity of a slice of samples (see samples), as a view."""
+        return self.data[self.quantities.index(quantity), samples]
+
+    def get(self, trial, quantity):
+        return self.values(quantity, self.samples(trial))
+
+    def xcoord(self, trial):
+        return self.get(trial, 'xcoord')
+
+    def ycoord(self, trial):
+        return self.get(trial, 'ycoord')
+
+    def magnitude(self, trial):
+        return self.get(trial, 'magnitude')
+
+
+def cache_paths(csv_path):
+    stem = os.path.splitext(csv_path)[0]
+    return stem + '.eyepos.npy', stem + '.eyepos.json'
+
+
+def trial_columns(columns):
+    """Maps every trial number found in the eye_pos header to its {quantity: column name} dict."""
+    trials = {}
+    for column in columns:
+        match = COLUMN_PATTERN.match(column)
+        if match:
+            trials.setdefault(int(match.group(1)), {})[match.group(2)] = column
+    return dict(sorted(trials.items()))
+
+
+def read_eyepos_header(csv_path):
+    """Maps every trial number of an eye_pos csv to its {quantity: column name} dict, reading only the header."""
+    return trial_columns(pd.read_csv(csv_path, nrows=0).columns)
+
+
+def select_columns(header, trials=None, quantities=QUANTITIES):
+    """Returns [(trial, quantity, column name)] for the requested trials and quantities that exist in the file."""
+    if trials is None:
+        trials = header.keys()
+    missing = [trial for trial in trials if trial not in header]
+    if missing:
+        raise Exception("Trials {} are not in the eye_pos file!".format(missing))
+    return [(trial, quantity, header[trial][quantity]) for trial in trials for quantity in quantities
+            if quantity in header[trial]]
+
+
+def iter_eyepos_chunks(csv_path, columns, chunk_rows=CHUNK_ROWS):
+    """Streams the given columns of an eye_pos csv, in that order, as float32 DataFrames of at most chunk_rows rows."""
+    names = [column for _, _, column in columns]
+    dtypes = {name: np.float32 for name in names}
+    with pd.read_csv(csv_path, usecols=names, dtype=dtypes, chunksize=chunk_rows) as reader:
+        for chunk in reader:
+            yield chunk[names]
+
+
+def scan_trial_lengths(csv_path, header, chunk_rows=CHUNK_ROWS):
+    """Finds the length of every trial (last row where any of its columns is valid, + 1) in one streaming pass."""
+    columns = select_columns(header)
+    lengths = dict.fromkeys(header, 0)
+    start_row = 0
+    for chunk in iter_eyepos_chunks(csv_path, columns, chunk_rows):
+        valid = chunk.notna().to_numpy()
+        last_rows = len(chunk) - np.argmax(valid[::-1], axis=0)
+        for (trial, _, _), any_valid, last_row in zip(columns, valid.any(axis=0), last_rows):
+            if any_valid:
+                lengths[trial] = max(lengths[trial], start_row + int(last_row))
+        start_row += len(chunk)
+    return lengths
+
+
+def read_eyepos_columns(csv_path, trials=None, quantities=QUANTITIES, chunk_rows=CHUNK_ROWS):
+    """
+    Reads only the requested trials and quantities of an eye_pos csv into an in-memory EyePosRun, without the cache.
+
+    Trailing NaN padding is dropped chunk by chunk. The offsets of the result only count the trials that were read,
+    so unless every trial of the file is read, the result has no offline time (see EyePosRun).
+    """
+    header = read_eyepos_header(csv_path)
+    trials = list(header.keys()) if trials is None else list(trials)
+    complete = trials == list(header.keys())
+    columns = select_columns(header, trials, quantities)
+
+    # only chunks holding valid samples are kept, so the NaN padding after a trial ends is never stored
+    pieces = {column: [] for _, _, column in columns}
+    lengths = dict.fromkeys(trials, 0)
+    start_row = 0
+    for chunk in iter_eyepos_chunks(csv_path, columns, chunk_rows):
+        for trial, _, column in columns:
+            values = chunk[column].to_numpy()
+            valid = np.flatnonzero(~np.isnan(values))
+            if len(valid):
+                lengths[trial] = max(lengths[trial], start_row + int(valid[-1]) + 1)
+                pieces[column].append((start_row, values))
+        start_row += len(chunk)
+
+    lengths = [lengths[trial] for trial in trials]
+    data = np.full((len(quantities), sum(lengths)), np.nan, dtype=np.float32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    for trial, quantity, column in columns:
+        i = trials.index(trial)
+        for row, values in pieces.pop(column):
+            values = values[:lengths[i] - row]
+            data[quantities.index(quantity), offsets[i] + row:offsets[i] + row + len(values)] = values
+    return EyePosRun(data, trials, lengths, quantities, complete)
+
+
+def build_eyepos_cache(csv_path, chunk_rows=CHUNK_ROWS):
+    """
+    Converts a wide, NaN padded eye_pos csv into the ragged binary cache and returns its index.
+
+    The csv is streamed twice in chunks (once to find the trial lengths, once to copy the samples straight into
+    the memory-mapped cache), so memory use does not grow with the length or width of the file.
+    """
+    header = read_eyepos_header(csv_path)
+    trial_lengths = scan_trial_lengths(csv_path, header, chunk_rows)
+    trials = list(header.keys())
+    lengths = [trial_lengths[trial] for trial in trials]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    data_path, index_path = cache_paths(csv_path)
+    # write to temporary files first so an interrupted conversion never leaves a half written cache behind
+    data = np.lib.format.open_memmap(data_path + '.tmp', mode='w+', dtype=np.float32,
+                                     shape=(len(QUANTITIES), int(offsets[-1])))
+    data[:] = np.nan
+    columns = select_columns(header)
+    positions = {trial: i for i, trial in enumerate(trials)}
+    start_row = 0
+    for chunk in iter_eyepos_chunks(csv_path, columns, chunk_rows):
+        for trial, quantity, column in columns:
+            i = positions[trial]
+            n_rows = min(len(chunk), lengths[i] - start_row)
+            if n_rows > 0:
+                destination = offsets[i] + start_row
+                data[QUANTITIES.index(quantity), destination:destination + n_rows] = chunk[column].to_numpy()[:n_rows]
+        start_row += len(chunk)
+    data.flush()
+    del data
+    os.replace(data_path + '.tmp', data_path)
+
+    stat = os.stat(csv_path)
+    index = {
+        'version': CACHE_VERSION,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'source_size': stat.st_size,
+        'source_sha1': file_hash(csv_path),
+        'trials': trials,
+        'lengths': lengths,
+    }
+    write_cache_index(index_path, index)
+    return index
+
+
+def write_cache_index(index_path, index):
+    with open(index_path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def read_cache_index(csv_path):
+    """Returns the cache index if the cache still matches csv_path, otherwise None."""
+    data_path, index_path = cache_paths(csv_path)
+    if not (os.path.exists(data_path) and os.path.exists(index_path)):
+        return None
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != CACHE_VERSION:
+        return None
+
+    stat = os.stat(csv_path)
+    if index['source_mtime_ns'] == stat.st_mtime_ns and index['source_size'] == stat.st_size:
+        return index
+
+    # the file was touched; only rebuild if its content actually changed
+    if index['source_size'] != stat.st_size or index['source_sha1'] != file_hash(csv_path):
+        return None
+    index['source_mtime_ns'] = stat.st_mtime_ns
+    write_cache_index(index_path, index)
+    return index
+
+
+def load_eyepos(csv_path, trials=None, quantities=QUANTITIES, use_cache=True):
+    """
+    Loads an eye_pos csv through its binary cache, (re)building the cache when the csv has changed.
+
+    The cache is memory-mapped, so only the trials that are used are read from disk. With use_cache=False
+    (e.g. a read-only data folder), only the requested trials and quantities are read from the csv instead.
+    """
+    if not use_cache:
+        with stage('load/eye_pos csv'):
+            return read_eyepos_columns(csv_path, trials, quantities)
+    with stage('load/eye_pos cache'):
+        index = read_cache_index(csv_path)
+        if index is None:
+            with stage('load/eye_pos csv to cache'):
+                index = build_eyepos_cache(csv_path)
+        data = np.load(cache_paths(csv_path)[0], mmap_mode='r')
+        return EyePosRun(data, index['trials'], index['lengths'])
@@ -0,0 +1,263 @@
+from abc import ABC, abstractmethod
+
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.container import StemContainer
+from matplotlib.legend import Legend
+from matplotlib.lines import Line2D
+from matplotlib.patches import Circle
+
+from eyepos_heatmap import heatmap_edges
+from instrumentation import stage
+
+
+def heatmap_colormap():
+    # Define color stops (positions must start at 0 and end at 1)
+    positions = [0.0, 0.25, 0.5, 0.75, 1.0]
+    colors = [
+        (1.0, 1.0, 1.0),  # white at 0%
+        (1.0, 1.0, 0.0),  # yellow at 25%
+        (1.0, 0.5, 0.0),  # orange at 50%
+        (1.0, 0.0, 0.0),  # red at 75%
+        (1.0, 0.0, 0.0)  # red at 100%
+    ]
+
+    # Create the colormap
+    return LinearSegmentedColormap.from_list("custom_heatmap", list(zip(positions, colors)))
+
+
+def stem_legend_handle(color, linestyle='-'):
+    """A stem container that is not attached to any axes, used as a legend handle."""
+    markerline = Line2D([], [], color=color, marker='o', linestyle='none')
+    stemlines = LineCollection([], colors=color, linestyles=linestyle)
+    baseline = Line2D([], [], linestyle='none')
+    return StemContainer((markerline, stemlines, baseline))
+
+
+def signal_graph_axes(graph):
+    """Y axis, axis labels and grid of the signal graph, in the normal mode and in SignalGraphTemplate."""
+    graph.set_ylim(0, 5.2)
+    custom_ticks = [0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
+    custom_labels = [0, 0.5, 1.0, 0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5]
+    graph.set_yticks(custom_ticks)
+    graph.set_yticklabels(custom_labels)
+    graph.set_xlabel("Time (ms)")
+    graph.set_ylabel("Signal       Deviation of Fixation (Deg)")
+    graph.grid(False)
+
+
+class EventLines:
+    """Stems of events (a LineCollection plus a marker line) whose positions can be swapped in place."""
+
+    def __init__(self, graph, height, color, linestyle='-', linewidth=None):
+        self.height = height
+        self.lines = graph.vlines([], 0, height, colors=color, linestyles=linestyle,
+                                  linewidths=linewidth if linewidth is not None else plt.rcParams['lines.linewidth'])
+        self.markers = graph.plot([], [], 'o', color=color)[0]
+
+    def set_x(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        self.lines.set_segments([[(value, 0), (value, self.height)] for value in x])
+        self.markers.set_data(x, np.full(len(x), self.height))
+
+    def set_color(self, color):
+        self.lines.set_color(color)
+        self.markers.set_color(color)
+
+
+class TemplateFigure:
+    """A figure of a template with its named artists and the legends built for it so far."""
+
+    def __init__(self, fig, graph):
+        self.fig = fig
+        self.graph = graph
+        self.name = 'figure'    # names the save stage in instrumentation reports
+        self.artists = {}
+        self.legends = {}
+
+    def show_legend(self, key, handles, labels, **kwargs):
+        """Shows the legend for key, building it the first time; legends of other keys are hidden."""
+        if key not in self.legends:
+            legend = Legend(self.graph, handles, labels, **kwargs)
+            self.graph.add_artist(legend)
+            legend.set_clip_on(False)   # add_artist clips to the axes, but the legends sit outside of them
+            self.legends[key] = legend
+        for legend_key, legend in self.legends.items():
+            legend.set_visible(legend_key == key)
+
+    def save(self, png_name, **kwargs):
+        with stage('save/' + self.name):
+            self.fig.savefig(png_name, dpi=100, **kwargs)
+
+
+class FigureTemplate(ABC):
+    """
+    Builds the figure of one graph type once per key (e.g. the number of trials) and reuses it for every call.
+
+    Subclasses create the figure, static artists and empty data artists in build(); rendering only swaps data into
+    these artists before saving, so no figure, axes, colorbar or legend is created again.
+    """
+
+    name = 'figure'
+
+    def __init__(self):
+        self._figures = {}
+
+    def figure(self, key):
+        if key not in self._figures:
+            plt.rcParams.update({'font.size': 20})
+            self._figures[key] = self.build(key)
+            self._figures[key].name = self.name
+        return self._figures[key]
+
+    @abstractmethod
+    def build(self, key):
+        """Returns the TemplateFigure for key."""
+
+    def close(self):
+        for page in self._figures.values():
+            plt.close(page.fig)
+        self._figures = {}
+
+
+class SignalGraphTemplate(FigureTemplate):
+    """Template of plot_everything_in_one_graph (fast mode artists), keyed by the number of trials."""
+
+    name = 'signal graph'
+
+    def build(self, n_trials):
+        fig, graph = plt.subplots(figsize=(50 * n_trials, 8))
+        page = TemplateFigure(fig, graph)
+
+        page.artists['eye_pos'] = graph.scatter([], [], marker='o', color='purple', s=2, rasterized=True)
+        page.artists['fixation'] = graph.axhline(y=1.5, color='red', linestyle='--')
+        page.artists['baseline'] = graph.plot([], [], color='gray', linewidth=3)[0]
+        page.artists['stimulus'] = graph.plot([], [], color='orange', linewidth=3)[0]
+        page.artists['ttl_between_trials'] = EventLines(graph, 0.1, 'b')
+        page.artists['trial_start'] = EventLines(graph, 1, 'k', linewidth=3)
+        page.artists['trial_end'] = EventLines(graph, 1, 'k', linestyle='--', linewidth=4.5)
+        page.artists['ttl'] = EventLines(graph, 0.1, 'b')
+        page.artists['reward'] = EventLines(graph, 1, 'g')
+        page.artists['punish'] = EventLines(graph, 1, 'r')
+
+        signal_graph_axes(graph)
+        return page
+
+    def render(self, page, data, x_limits, title, png_name, pil_kwargs=None):
+        """data is the output of plot_graphs.fast_signal_graph_data for page's axes."""
+        page.artists['eye_pos'].set_offsets(np.column_stack(data['eye_pos']))
+        page.artists['baseline'].set_data(*data['baseline'])
+        page.artists['stimulus'].set_data(*data['stimulus'])
+        for name in ['ttl_between_trials', 'trial_start', 'trial_end', 'ttl', 'reward', 'punish']:
+            page.artists[name].set_x(data[name])
+        page.graph.set_xlim(*x_limits)
+        page.graph.set_title(title)
+
+        # same entries, in the same order, as the legend of plot_everything_in_one_graph
+        has_reward = len(data['reward']) != 0
+        has_punish = len(data['punish']) != 0
+        handles = [page.artists['eye_pos'], page.artists['fixation'], page.artists['baseline'],
+                   page.artists['stimulus'], Line2D([], [], color='black', linestyle='-'),
+                   Line2D([], [], color='black', linestyle='--'), stem_legend_handle('b')]
+        labels = ['Eye Position', 'Fixation at 1.5', 'Baseline', 'Stimulus', 'Trial Start', 'Trial End', 'TTL']
+        if has_reward:
+            handles.append(stem_legend_handle('g'))
+            labels.append('Reward')
+        if has_punish:
+            handles.append(stem_legend_handle('r'))
+            labels.append('No Reward')
+        page.show_legend((has_reward, has_punish), handles, labels, bbox_to_anchor=(1.0, 1.15), loc='upper left')
+
+        page.save(png_name, bbox_inches='tight', pil_kwargs=pil_kwargs)
+
+
+class HeatmapTemplate(FigureTemplate):
+    """Template of generate_eye_pos_heatmap, keyed by the tile size."""
+
+    name = 'heatmap'
+
+    def build(self, bin_size):
+        fig, graph = plt.subplots(figsize=(16, 12))
+        page = TemplateFigure(fig, graph)
+
+        x_edges = heatmap_edges(bin_size)
+        y_edges = heatmap_edges(bin_size)
+        page.artists['heatmap'] = graph.imshow(
+            np.zeros((len(y_edges) - 1, len(x_edges) - 1)),
+            origin='lower',  # so [0,0] is bottom-left
+            extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]],
+            cmap=heatmap_colormap(),
+            aspect='auto',
+            vmin=0,
+            vmax=15
+        )
+        page.artists['circle'] = Circle((0, 0), 1, color='blue', linestyle='--', linewidth=1, fill=False)
+        graph.add_patch(page.artists['circle'])
+
+        plt.colorbar(page.artists['heatmap'], ax=graph, label='Percentage of Data Points (%)')
+        graph.set_xlabel('X (Deg)')
+        graph.set_ylabel('Y (Deg)')
+        return page
+
+    def render(self, page, heatmap_percent, fixation, title, png_name):
+        page.artists['heatmap'].set_data(heatmap_percent.T)  # transpose so x/y axes match visually
+        page.artists['circle'].set_radius(fixation)
+        page.graph.set_title(title, pad=30)
+        page.save(png_name, bbox_inches='tight')
+
+
+class TimelineTileTemplate(FigureTemplate):
+    """
+    Template of the tiles of timeline_tiles.py, keyed by the tile size in pixels.
+
+    The axes fill the whole image and have no ticks, so neighbouring tiles line up exactly in the viewer. The eye
+    trace is drawn as one vertical min/max segment per pixel column, all in one path broken by NaN.
+    """
+
+    name = 'timeline tile'
+
+    def build(self, size_px):
+        width_px, height_px = size_px
+        fig = plt.figure(figsize=(width_px / 100, height_px / 100))
+        graph = fig.add_axes([0, 0, 1, 1])
+        graph.set_axis_off()
+        page = TemplateFigure(fig, graph)
+
+        # 0.72 points is one pixel at 100 dpi
+        page.artists['eye_pos'] = graph.plot([], [], color='purple', linewidth=0.72, antialiased=False)[0]
+        page.artists['fixation'] = graph.axhline(y=1.5, color='red', linestyle='--')
+        page.artists['baseline'] = graph.plot([], [], color='gray', linewidth=3)[0]
+        page.artists['stimulus'] = graph.plot([], [], color='orange', linewidth=3)[0]
+        page.artists['ttl_between_trials'] = EventLines(graph, 0.1, 'b')
+        page.artists['trial_start'] = EventLines(graph, 1, 'k', linewidth=3)
+        page.artists['trial_end'] = EventLines(graph, 1, 'k', linestyle='--', linewidth=4.5)
+        page.artists['ttl'] = EventLines(graph, 0.1, 'b')
+        page.artists['reward'] = EventLines(graph, 1, 'g')
+        page.artists['punish'] = EventLines(graph, 1, 'r')
+        graph.set_ylim(0, 5.2)
+        return page
+
+    def set_events(self, page, data):
+        """data is the output of plot_graphs.signal_event_data for the whole run; it is the same for every tile."""
+        page.artists['baseline'].set_data(*data['baseline'])
+        page.artists['stimulus'].set_data(*data['stimulus'])
+        for name in ['ttl_between_trials', 'trial_start', 'trial_end', 'ttl', 'reward', 'punish']:
+            page.artists[name].set_x(data[name])
+
+    def render(self, page, x_limits, envelope_min, envelope_max, png_name, pil_kwargs=None):
+        """envelope_min and envelope_max hold the eye trace of each pixel column of the tile (NaN where empty)."""
+        width_px = len(envelope_min)
+        half_px = 0.5 * 5.2 / (page.fig.get_figheight() * 100)
+        column = np.flatnonzero(~np.isnan(envelope_min))
+        x = x_limits[0] + (column + 0.5) * (x_limits[1] - x_limits[0]) / width_px
+        segments_x = np.full((len(column), 3), np.nan)
+        segments_y = np.full((len(column), 3), np.nan)
+        segments_x[:, 0] = x
+        segments_x[:, 1] = x
+        segments_y[:, 0] = envelope_min[column] - half_px
+        segments_y[:, 1] = envelope_max[column] + half_px
+        page.artists['eye_pos'].set_data(segments_x.ravel(), segments_y.ravel())
+        page.graph.set_xlim(*x_limits)
+        page.save(png_name, pil_kwargs=pil_kwargs)
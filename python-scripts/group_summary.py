@@ -0,0 +1,213 @@
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use('Agg')   # headless, must be selected before figure_templates imports pyplot
+
+import numpy as np
+import pandas as pd
+
+from censor_sweep import fixation_counts
+from eyepos_censor import TR_SAMPLES, load_magnitude_block
+from eyepos_heatmap import heatmap_edges, trial_histogram
+from figure_templates import HeatmapTemplate
+from session_events import load_session_events
+from session_paths import run_csv_files, run_paths
+
+SUMMARY_VERSION = 2
+SUMMARY_FOLDER = 'run-summaries'    # inside every session folder
+OUTCOMES = ('all', 'reward', 'punish')
+
+
+def summary_path(target_folder, run_num):
+    session = os.path.basename(os.path.normpath(target_folder))
+    return os.path.join(target_folder, SUMMARY_FOLDER, "{}-run{:02d}-summary.npz".format(session, run_num))
+
+
+def summary_key(target_folder, run_num, tile_size, fixations):
+    """Identifies the csv files (by size and mtime) and the parameters a summary was made from."""
+    files = run_paths(target_folder, run_num)[:2]
+    stats = [[os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns] for path in files]
+    return json.dumps({'version': SUMMARY_VERSION, 'inputs': stats, 'tile_size': tile_size,
+                       'fixations': list(fixations)})
+
+
+def event_counts(event_times, trials):
+    """Number of events of every trial, from the per-trial offsets of an EventTimes (0 past its last trial)."""
+    counts = np.diff(event_times.offsets)
+    trials = np.asarray(trials, dtype=np.int64)
+    return np.where(trials < len(counts), counts[np.minimum(trials, len(counts) - 1)], 0).astype(np.int32)
+
+
+def summarize_run(target_folder, run_num, tile_size, fixations):
+    """
+    Reduces one run to what the group summaries need and writes it to the run's summary file:
+    the heatmap histogram and sample count of every trial, the within-fixation fraction of every TR for every
+    radius, and the number of reward and punish events of every trial. Returns the path of the summary.
+    """
+    filepath_signal, filepath_eyepos, _ = run_paths(target_folder, run_num)
+    events = load_session_events(filepath_signal, filepath_eyepos)
+    eye_pos = events.eye_pos
+    trials = eye_pos.trials
+
+    edges = heatmap_edges(tile_size)
+    histograms = np.stack([trial_histogram(eye_pos.xcoord(trial), eye_pos.ycoord(trial), edges)
+                           for trial in trials]).astype(np.int32)
+
+    block, lengths = load_magnitude_block(eye_pos, trials)
+    n_trs = -(-lengths // TR_SAMPLES)
+    # the same rate as the percentage censor: samples inside the radius over a full TR
+    within = fixation_counts(block, fixations) / TR_SAMPLES
+    valid = np.arange(within.shape[1]) < n_trs[:, None]
+
+    path = summary_path(target_folder, run_num)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, key=summary_key(target_folder, run_num, tile_size, fixations),
+                 trials=np.array(trials), samples=eye_pos.lengths, histograms=histograms,
+                 tr_trial=np.repeat(np.array(trials), n_trs), tr_within=within[valid].astype(np.float32),
+                 reward_counts=event_counts(events.reward, trials), punish_counts=event_counts(events.punish, trials))
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def is_cached(target_folder, run_num, tile_size, fixations):
+    path = summary_path(target_folder, run_num)
+    if not os.path.exists(path):
+        return False
+    with np.load(path) as summary:
+        return str(summary['key']) == summary_key(target_folder, run_num, tile_size, fixations)
+
+
+def find_runs(root, pattern='sess*'):
+    """(session folder, run number) of every run with both csv files, in every session folder under root."""
+    runs = []
+    for target_folder in sorted(glob.glob(os.path.join(root, pattern))):
+        if os.path.isdir(os.path.join(target_folder, 'csv')):
+            runs += [(target_folder, run_num) for run_num, files in sorted(run_csv_files(target_folder).items())
+                     if len(files) == 2]
+    return runs
+
+
+def load_groups(groups_csv, group_by):
+    """{session name: tuple of the group_by columns} from a csv with a 'session' column, e.g. session,animal,condition."""
+    if groups_csv is None:
+        return {}
+    table = pd.read_csv(groups_csv, dtype=str)
+    return {row['session']: tuple(row[column] for column in group_by) for _, row in table.iterrows()}
+
+
+def summarize_runs(runs, tile_size, fixations, workers=None, force=False):
+    """Makes the summary of every run that has none or an outdated one, on a process pool."""
+    stale = [run for run in runs if force or not is_cached(run[0], run[1], tile_size, fixations)]
+    print("{} runs, {} to summarize".format(len(runs), len(stale)))
+    if not stale:
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(summarize_run, target_folder, run_num, tile_size, fixations):
+                   (target_folder, run_num) for target_folder, run_num in stale}
+        for future in as_completed(futures):
+            target_folder, run_num = futures[future]
+            future.result()
+            print("  summarized {} run {}".format(os.path.basename(os.path.normpath(target_folder)), run_num))
+
+
+def merge_summaries(runs, fixations, groups, group_by):
+    """
+    Merges the run summaries one at a time into the group heatmaps and the trend table of every run.
+
+    Returns ({(group, outcome): (counts, samples)}, run table). Only one run summary is in memory at a time.
+    """
+    heatmaps = {}
+    rows = []
+    for target_folder, run_num in runs:
+        session = os.path.basename(os.path.normpath(target_folder))
+        group = groups.get(session, ('unknown',) * len(group_by)) if group_by else ('all',)
+        with np.load(summary_path(target_folder, run_num)) as summary:
+            histograms = summary['histograms']
+            samples = summary['samples']
+            reward_counts = summary['reward_counts']
+            punish_counts = summary['punish_counts']
+            tr_within = summary['tr_within']
+
+        for outcome, trials in zip(OUTCOMES, (np.ones(len(samples), dtype=bool), reward_counts > 0, punish_counts > 0)):
+            counts, total = heatmaps.get((group, outcome), (0, 0))
+            heatmaps[(group, outcome)] = (counts + histograms[trials].sum(axis=0, dtype=np.int64),
+                                          total + int(samples[trials].sum()))
+
+        row = dict(zip(group_by, group))
+        row.update({'session': session, 'run': run_num, 'trials': len(samples), 'trs': len(tr_within),
+                    'rewards': int(reward_counts.sum()), 'punishes': int(punish_counts.sum()),
+                    'rewarded_trials': int((reward_counts > 0).sum()),
+                    'punished_trials': int((punish_counts > 0).sum())})
+        for i, fixation in enumerate(fixations):
+            row['within_{:g}'.format(fixation)] = float(tr_within[:, i].mean()) if len(tr_within) else np.nan
+        rows.append(row)
+    return heatmaps, pd.DataFrame(rows)
+
+
+def session_trends(run_table, fixations, group_by):
+    """Per session totals of the run table; the within-fixation fractions are weighted by the TRs of every run."""
+    columns = ['within_{:g}'.format(fixation) for fixation in fixations]
+    weighted = run_table[columns].multiply(run_table['trs'], axis=0)
+    counts = ['trials', 'trs', 'rewards', 'punishes', 'rewarded_trials', 'punished_trials']
+    table = pd.concat([run_table[list(group_by) + ['session'] + counts], weighted], axis=1)
+    sessions = table.groupby(list(group_by) + ['session'], sort=True, as_index=False).sum()
+    sessions[columns] = sessions[columns].divide(sessions['trs'], axis=0)
+    sessions.insert(len(group_by) + 1, 'runs', run_table.groupby(list(group_by) + ['session'], sort=True).size()
+                    .to_numpy())
+    return sessions
+
+
+def write_group_summary(root, output_folder, tile_size=0.1, fixations=(0.8,), groups_csv=None, group_by=(),
+                        pattern='sess*', workers=None, force=False):
+    """Summarizes every run under root (reusing cached summaries) and writes group heatmaps and trend tables."""
+    start = time.perf_counter()
+    runs = find_runs(root, pattern)
+    summarize_runs(runs, tile_size, fixations, workers, force)
+    heatmaps, run_table = merge_summaries(runs, fixations, load_groups(groups_csv, group_by), group_by)
+
+    os.makedirs(output_folder, exist_ok=True)
+    run_table.to_csv(os.path.join(output_folder, 'trends-runs.csv'), index=False)
+    if len(run_table):
+        session_trends(run_table, fixations, group_by).to_csv(os.path.join(output_folder, 'trends-sessions.csv'),
+                                                              index=False)
+
+    template = HeatmapTemplate()
+    for (group, outcome), (counts, samples) in sorted(heatmaps.items()):
+        if samples == 0:
+            continue
+        name = '-'.join(list(group) + [outcome])
+        np.savez(os.path.join(output_folder, 'heatmap-{}.npz'.format(name)), counts=counts, samples=samples,
+                 edges=heatmap_edges(tile_size))
+        label = ' '.join(group) if group_by else 'All sessions'
+        title = "{} Eye Position Heatmap (Radius={}, Tile_size={}), {} trials".format(label, fixations[0], tile_size,
+                                                                                      outcome)
+        template.render(template.figure(tile_size), counts / samples * 100, fixations[0], title,
+                        os.path.join(output_folder, 'heatmap-{}.png'.format(name)))
+    print("{} runs merged in {:.1f}s, written to {}".format(len(runs), time.perf_counter() - start, output_folder))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fixation summaries across sessions: group heatmaps and trend tables.")
+    parser.add_argument('root', help="the folder that contains the session folders")
+    parser.add_argument('--pattern', default='sess*', help="session folder names (default: sess*)")
+    parser.add_argument('--output', default=None, help="output folder (default: <root>/group-summary)")
+    parser.add_argument('--tile-size', type=float, default=0.1, help="the tile size in the heatmap")
+    parser.add_argument('--fixation', type=float, nargs='+', default=[0.8],
+                        help="fixation radii of the within-fixation fractions; the first one is drawn on the heatmaps")
+    parser.add_argument('--groups', default=None,
+                        help="csv with a 'session' column and the columns to group by, e.g. session,animal,condition")
+    parser.add_argument('--group-by', nargs='+', default=[], help="columns of --groups to group the sessions by")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--force', action='store_true', help="summarize every run again, even cached ones")
+    args = parser.parse_args()
+
+    if args.group_by and args.groups is None:
+        parser.error("--group-by needs --groups")
+    write_group_summary(args.root, args.output or os.path.join(args.root, 'group-summary'), args.tile_size,
+                        args.fixation, args.groups, args.group_by, args.pattern, args.workers, args.force)
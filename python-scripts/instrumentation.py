@@ -0,0 +1,233 @@
+import cProfile
+import functools
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+
+ENV_VARIABLE = 'FMRI_INSTRUMENT'    # '1' to write reports, 'profile' to also write cProfile files
+REPORT_NAME = 'instrumentation.json'
+SUMMARY_NAME = 'instrumentation-summary.json'
+CATEGORIES = ('load', 'index', 'compute', 'render', 'save')
+MAX_TIMELINE = 100000
+
+_enabled = False
+_profile = False
+_current = None     # the Report of the run being recorded, None when disabled or between runs
+_session = []       # finished run reports, for the session summary
+_NULL_STAGE = nullcontext()
+
+
+def reset_peak_rss():
+    """Resets the peak RSS of this process where the kernel allows it (Linux), so each stage gets its own peak."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource     # Unix only
+    except ImportError:
+        return 0.0          # e.g. Windows: no peak memory, only times are reported
+    # ru_maxrss is in kB on Linux and in bytes on macOS; it cannot be reset, so stages report the peak so far
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+class Stage:
+    """One open stage. Its time minus the time of the stages nested in it is its self time."""
+
+    def __init__(self, report, name):
+        self.report = report
+        self.name = name
+
+    def __enter__(self):
+        self.report.fold_peak()
+        reset_peak_rss()
+        self.peak = 0.0
+        self.children = 0.0
+        self.report.open.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        wall = end - self.start
+        self.report.fold_peak()
+        self.report.open.pop()
+        if self.report.open:
+            self.report.open[-1].children += wall
+        self.report.add(self.name, wall, wall - self.children, self.peak, self.start, end)
+        return False
+
+
+class Report:
+    """Stages of one run, accumulated by name."""
+
+    def __init__(self, name, meta):
+        self.name = name
+        self.meta = meta
+        self.stages = {}
+        self.open = []
+        self.timeline = []
+        self.peak = 0.0
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.profiler = None
+
+    def fold_peak(self):
+        # the peak since the last reset belongs to every stage that is open, so it is kept before resetting again
+        peak = peak_rss_mb()
+        self.peak = max(self.peak, peak)
+        for stage in self.open:
+            stage.peak = max(stage.peak, peak)
+
+    def add(self, name, wall, self_time, peak, start, end):
+        stats = self.stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'self_s': 0.0, 'max_call_s': 0.0,
+                                              'peak_rss_mb': 0.0})
+        stats['calls'] += 1
+        stats['wall_s'] += wall
+        stats['self_s'] += self_time
+        stats['max_call_s'] = max(stats['max_call_s'], wall)
+        stats['peak_rss_mb'] = max(stats['peak_rss_mb'], peak)
+        if _profile and len(self.timeline) < MAX_TIMELINE:
+            # wall clock times, to line the stages up with py-spy or other sampling profilers
+            offset = self.started - self.start
+            self.timeline.append([name, start + offset, end + offset])
+
+    def as_dict(self):
+        self.fold_peak()
+        return {
+            'name': self.name,
+            'meta': self.meta,
+            'pid': os.getpid(),
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_s': time.perf_counter() - self.start,
+            'peak_rss_mb': self.peak,
+            'categories': category_times(self.stages),
+            'stages': self.stages,
+            'timeline': self.timeline,
+        }
+
+
+def category_times(stages):
+    """Self time per category (the part of a stage name before '/'), so nested stages are not counted twice."""
+    times = dict.fromkeys(CATEGORIES, 0.0)
+    for name, stats in stages.items():
+        category = name.split('/')[0]
+        times[category] = times.get(category, 0.0) + stats['self_s']
+    return times
+
+
+def enable(profile=False):
+    global _enabled, _profile
+    _enabled = True
+    _profile = profile
+
+
+def enable_from_env():
+    """Enables instrumentation if FMRI_INSTRUMENT is set, so production batches can turn it on without edits."""
+    value = os.environ.get(ENV_VARIABLE, '')
+    if value:
+        enable(profile=value == 'profile')
+
+
+def begin_run(name, **meta):
+    """Starts the report of one run; does nothing unless enabled."""
+    global _current
+    if not _enabled:
+        return
+    _current = Report(name, meta)
+    reset_peak_rss()
+    if _profile:
+        _current.profiler = cProfile.Profile()
+        _current.profiler.enable()
+
+
+def end_run(report_path):
+    """Writes the report of the current run as JSON (plus report_path + '.prof' when profiling) and returns it."""
+    global _current
+    if _current is None:
+        return None
+    report = _current
+    _current = None
+    if report.profiler is not None:
+        report.profiler.disable()
+        report.profiler.dump_stats(report_path + '.prof')
+    result = report.as_dict()
+    result['profile'] = report_path + '.prof' if report.profiler is not None else None
+    write_json(report_path, result)
+    _session.append(result)
+    return result
+
+
+def write_session_summary(summary_path):
+    """Writes the totals of every run reported so far, e.g. all runs of a session."""
+    if not _session:
+        return None
+    categories = dict.fromkeys(CATEGORIES, 0.0)
+    stages = {}
+    for run in _session:
+        for category, seconds in run['categories'].items():
+            categories[category] = categories.get(category, 0.0) + seconds
+        for name, stats in run['stages'].items():
+            total = stages.setdefault(name, {'calls': 0, 'wall_s': 0.0, 'self_s': 0.0, 'max_call_s': 0.0,
+                                             'peak_rss_mb': 0.0})
+            total['calls'] += stats['calls']
+            total['wall_s'] += stats['wall_s']
+            total['self_s'] += stats['self_s']
+            total['max_call_s'] = max(total['max_call_s'], stats['max_call_s'])
+            total['peak_rss_mb'] = max(total['peak_rss_mb'], stats['peak_rss_mb'])
+    summary = {
+        'runs': [{key: run[key] for key in ('name', 'meta', 'wall_s', 'peak_rss_mb', 'categories')}
+                 for run in _session],
+        'wall_s': sum(run['wall_s'] for run in _session),
+        'peak_rss_mb': max(run['peak_rss_mb'] for run in _session),
+        'categories': categories,
+        'stages': stages,
+    }
+    write_json(summary_path, summary)
+    return summary
+
+
+def write_json(path, data):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the current run, e.g. with stage('load/eye_pos cache'): ...
+
+    Names start with a category (load, index, compute, render or save). When no run is being recorded this
+    returns a shared no-op context, so instrumented code costs one global lookup.
+    """
+    if _current is None:
+        return _NULL_STAGE
+    return Stage(_current, name)
+
+
+def instrumented(name):
+    """Decorator recording every call of a function as a stage."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _current is None:
+                return function(*args, **kwargs)
+            with Stage(_current, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
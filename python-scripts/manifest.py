@@ -0,0 +1,38 @@
+import hashlib
+import json
+import os
+
+
+def file_hash(path, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'inputs': {}, 'outputs': {}}
+
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def hash_inputs(paths, manifest):
+    """Content hashes of input files, only re-hashing files whose mtime or size changed since the manifest saw them."""
+    hashes = {}
+    for path in paths:
+        stat = os.stat(path)
+        known = manifest['inputs'].get(path)
+        if known is None or known['mtime_ns'] != stat.st_mtime_ns or known['size'] != stat.st_size:
+            known = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha1': file_hash(path)}
+            manifest['inputs'][path] = known
+        hashes[path] = known['sha1']
+    return hashes
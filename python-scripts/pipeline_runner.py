@@ -0,0 +1,362 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from manifest import hash_inputs, load_manifest, save_manifest
+from session_paths import run_paths
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_NAME = 'pipeline-manifest.json'
+REPORT_NAME = 'pipeline-report.json'
+LOG_FOLDER = 'pipeline-logs'
+TOOLS = ('dcm2niix', 'fslsplit', 'bet', 'fslmerge', 'tcsh')
+
+
+class Task:
+    """
+    One command of the pipeline, with the files it reads and writes.
+
+    A task runs once every task writing one of its inputs is done. outputs may be files or folders. A task with
+    expand adds more tasks to the pipeline once it is done, e.g. one bet per frame after fslsplit; it lists the
+    files those tasks will write in promises, so tasks reading them wait for them too.
+    """
+
+    def __init__(self, name, stage, command, inputs=(), outputs=(), params=None, cwd=None, clean=(), promises=(),
+                 expand=None):
+        self.name = name
+        self.stage = stage
+        self.command = [str(arg) for arg in command]
+        self.inputs = [os.path.abspath(path) for path in inputs]
+        self.outputs = [os.path.abspath(path) for path in outputs]
+        self.params = params or {}
+        self.cwd = cwd
+        self.clean = [os.path.abspath(path) for path in clean]     # folders emptied before the command runs
+        self.promises = [os.path.abspath(path) for path in promises]
+        self.expand = expand
+
+    def key(self, input_hashes):
+        """Content key of the task: its command, parameters and the content of its inputs."""
+        description = {
+            'command': self.command,
+            'params': self.params,
+            'cwd': self.cwd,
+            'inputs': [[path, input_hashes[path]] for path in self.inputs],
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def __str__(self):
+        return self.name
+
+
+def input_files(paths):
+    """The files behind a list of inputs, with every file of an input folder (e.g. the dicom folder)."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, names in sorted(os.walk(path)):
+                files += [os.path.join(folder, name) for name in sorted(names)]
+        else:
+            files.append(path)
+    return files
+
+
+def input_hashes(task, manifest):
+    """Hash of every input of the task; a folder hashes to the hash of its file names and contents."""
+    hashes = {}
+    for path in task.inputs:
+        files = input_files([path])
+        file_hashes = hash_inputs(files, manifest)
+        if os.path.isdir(path):
+            listing = [[os.path.relpath(name, path), file_hashes[name]] for name in files]
+            hashes[path] = hashlib.sha1(json.dumps(listing).encode()).hexdigest()
+        else:
+            hashes[path] = file_hashes[path]
+    return hashes
+
+
+def run_command(task, log_path):
+    """Runs one task, writing its output to its log. Returns (seconds, error)."""
+    start = time.perf_counter()
+    for path in task.clean:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    for path in task.outputs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(log_path + '.tmp', 'w') as log:
+        log.write('$ {}\n'.format(' '.join(task.command)))
+        log.flush()
+        try:
+            returncode = subprocess.run(task.command, cwd=task.cwd, stdout=log, stderr=subprocess.STDOUT).returncode
+        except OSError as error:
+            return time.perf_counter() - start, str(error)
+    seconds = time.perf_counter() - start
+    if returncode != 0:
+        return seconds, "exit code {}, see {}".format(returncode, log_path + '.tmp')
+    missing = [path for path in task.outputs if not os.path.exists(path)]
+    if missing:
+        return seconds, "did not write " + ', '.join(missing)
+    # the log is the task's stamp: it only exists once the task has succeeded
+    os.replace(log_path + '.tmp', log_path)
+    return seconds, None
+
+
+def run_pipeline(tasks, folder, workers=None, force=False):
+    """
+    Runs the tasks in dependency order, at most workers at a time, skipping tasks that are up to date.
+
+    A task is up to date when its key (command, parameters and input contents) is the one of its last successful
+    run and its outputs still exist, so changing one parameter only reruns the tasks it reaches. A failed task
+    blocks the tasks depending on it; the others still run. Returns the report, also written to folder.
+    """
+    manifest_path = os.path.join(folder, MANIFEST_NAME)
+    log_folder = os.path.join(folder, LOG_FOLDER)
+    os.makedirs(log_folder, exist_ok=True)
+    manifest = load_manifest(manifest_path)
+    manifest.setdefault('tasks', {})
+
+    pending = list(tasks)
+    names = set()
+    status = {}
+    producers = {}
+
+    def add(new_tasks):
+        for task in new_tasks:
+            if task.name in names:
+                raise Exception("Two tasks are named {}!".format(task.name))
+            names.add(task.name)
+            for path in task.outputs + task.promises:
+                producers.setdefault(path, []).append(task.name)
+        return new_tasks
+
+    add(pending)
+    report = []
+    start = time.perf_counter()
+
+    def finish(task, result, seconds, error=None, started=None):
+        status[task.name] = result
+        report.append({'task': task.name, 'stage': task.stage, 'status': result, 'seconds': seconds,
+                       'start_s': started, 'error': error})
+        print("{:>8} {:8.2f}s  {}{}".format(result, seconds, task, '' if error is None else '  ' + error))
+        if result in ('done', 'skipped') and task.expand is not None:
+            pending.extend(add(task.expand(task)))
+
+    def submit(task):
+        missing = [path for path in task.inputs if not os.path.exists(path)]
+        if missing:
+            finish(task, 'failed', 0.0, "missing " + ', '.join(missing))
+            return
+        key = task.key(input_hashes(task, manifest))
+        log_path = os.path.join(log_folder, task.name.replace('/', '_') + '.log')
+        up_to_date = (manifest['tasks'].get(task.name) == key and os.path.exists(log_path)
+                      and all(os.path.exists(path) for path in task.outputs))
+        if up_to_date and not force:
+            finish(task, 'skipped', 0.0)
+            return
+        manifest['tasks'].pop(task.name, None)
+        running[executor.submit(run_command, task, log_path)] = (task, key, time.perf_counter() - start)
+
+    running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while pending or running:
+                # skipping a task may add tasks (expand) that are ready at once, so schedule until nothing changes
+                scheduled = True
+                while scheduled:
+                    scheduled = False
+                    for task in list(pending):
+                        waiting = [name for path in task.inputs for name in producers.get(path, [])
+                                   if name != task.name]
+                        if any(status.get(name) in ('failed', 'blocked') for name in waiting):
+                            pending.remove(task)
+                            finish(task, 'blocked', 0.0, "an input failed")
+                        elif all(name in status for name in waiting):
+                            pending.remove(task)
+                            submit(task)
+                        else:
+                            continue
+                        scheduled = True
+
+                if not running:
+                    if pending:
+                        raise Exception("Tasks waiting on each other: " + ', '.join(map(str, pending)))
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, key, started = running.pop(future)
+                    seconds, error = future.result()
+                    if error is None:
+                        manifest['tasks'][task.name] = key
+                        save_manifest(manifest_path, manifest)
+                    finish(task, 'done' if error is None else 'failed', seconds, error, started)
+    finally:
+        save_manifest(manifest_path, manifest)
+        write_report(os.path.join(folder, REPORT_NAME), report, time.perf_counter() - start)
+    return report
+
+
+def write_report(path, report, wall):
+    """Writes the duration of every task, plus the busy time and wall span of every stage."""
+    stages = {}
+    for entry in report:
+        stage = stages.setdefault(entry['stage'], {'tasks': 0, 'done': 0, 'skipped': 0, 'failed': 0, 'blocked': 0,
+                                                   'busy_s': 0.0, 'first_start_s': None, 'last_end_s': None})
+        stage['tasks'] += 1
+        stage[entry['status']] += 1
+        stage['busy_s'] += entry['seconds']
+        if entry['start_s'] is not None:
+            end = entry['start_s'] + entry['seconds']
+            stage['first_start_s'] = min(stage['first_start_s'] if stage['first_start_s'] is not None else end,
+                                         entry['start_s'])
+            stage['last_end_s'] = max(stage['last_end_s'] or 0.0, end)
+    for stage in stages.values():
+        stage['wall_s'] = stage['last_end_s'] - stage['first_start_s'] if stage['last_end_s'] is not None else 0.0
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'wall_s': wall, 'stages': stages, 'tasks': report}, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def print_summary(report):
+    counts = {result: sum(1 for entry in report if entry['status'] == result)
+              for result in ('done', 'skipped', 'failed', 'blocked')}
+    print("{done} done, {skipped} up to date, {failed} failed, {blocked} blocked".format(**counts))
+    stages = {}
+    for entry in report:
+        stages[entry['stage']] = stages.get(entry['stage'], 0.0) + entry['seconds']
+    for stage, seconds in stages.items():
+        print("  {:<12} {:8.2f}s".format(stage, seconds))
+
+
+def tool_commands(config, stub=False):
+    """The command of every external tool: the config's 'tools' entry, the tool itself, or its stub."""
+    if stub:
+        return {tool: [sys.executable, os.path.join(SCRIPT_FOLDER, 'tool_stubs.py'), tool] for tool in TOOLS}
+    tools = config.get('tools', {})
+    return {tool: [tools[tool]] if isinstance(tools.get(tool), str) else tools.get(tool, [tool]) for tool in TOOLS}
+
+
+def skull_strip_tasks(name, epi, ss_output, work_folder, tools, bet_options):
+    """fslsplit, bet per frame and fslmerge of one run, like ss.bash; the bet and merge tasks come after the split."""
+    frames_folder = os.path.join(work_folder, name)
+    prefix = os.path.join(frames_folder, 'vol')
+
+    def frame_tasks(split):
+        frames = sorted(glob.glob(prefix + '[0-9]*.nii*'))
+        brains = [os.path.join(frames_folder, 'brain', os.path.basename(frame)) for frame in frames]
+        tasks = [Task('bet/{}/{}'.format(name, i), 'bet', tools['bet'] + [frame, brain] + bet_options,
+                      inputs=[frame], outputs=[brain], params={'bet': bet_options})
+                 for i, (frame, brain) in enumerate(zip(frames, brains))]
+        tasks.append(Task('fslmerge/' + name, 'fslmerge', tools['fslmerge'] + ['-t', ss_output] + brains,
+                          inputs=brains, outputs=[ss_output]))
+        return tasks
+
+    # old frames are removed first, so a shorter run never picks up frames of an earlier conversion
+    split = Task('fslsplit/' + name, 'fslsplit', tools['fslsplit'] + [epi, prefix, '-t'], inputs=[epi],
+                 outputs=[frames_folder], clean=[frames_folder], promises=[ss_output], expand=frame_tasks)
+    return [split]
+
+
+def session_tasks(config, config_folder, tools):
+    """
+    The tasks of one session: dcm2niix, skull stripping per run, signal graphs and heatmaps per run, the eye
+    censor of the session and the afni_proc script. See the README for the config file.
+    """
+    def path(key, default=None):
+        value = config.get(key, default)
+        return None if value is None else os.path.normpath(os.path.join(config_folder, value))
+
+    def session_path(key, name):
+        # key, or name inside the session folder
+        value = path(key)
+        if value is None:
+            if session_folder is None:
+                raise Exception("The config needs \"{}\" or \"session_folder\"!".format(key))
+            value = os.path.join(session_folder, name)
+        return value
+
+    session_folder = path('session_folder')
+    epi_folder = session_path('epi_folder', 'func')
+    work_folder = os.path.join(epi_folder, 'skull-strip')
+    eye_folder = path('eye_folder')
+    compress = config.get('compress', False)
+    extension = '.nii.gz' if compress else '.nii'
+    runs = sorted((int(run), name) for run, name in config['runs'].items())
+
+    tasks = []
+    epis = {run: os.path.join(epi_folder, name + extension) for run, name in runs}
+    dicom_folder = path('dicom_folder')
+    if dicom_folder is not None:
+        tasks.append(Task('dcm2niix', 'dcm2niix', tools['dcm2niix'] + ['-z', 'y' if compress else 'n', '-f',
+                                                                       config.get('name_format', '%p_%t_%s'),
+                                                                       '-o', epi_folder, dicom_folder],
+                          inputs=[dicom_folder], outputs=list(epis.values())))
+
+    ss_files = {}
+    for run, name in runs:
+        ss_files[run] = os.path.join(epi_folder, name + '-ss.nii.gz')
+        tasks += skull_strip_tasks(name, epis[run], ss_files[run], work_folder, tools, config.get('bet_options', []))
+
+    python = [sys.executable]
+    signal_csv = {}
+    if eye_folder is not None:
+        render = config.get('render', {})
+        for run, _ in runs:
+            filepath_signal, filepath_eyepos, output_folder = run_paths(eye_folder, run)
+            signal_csv[run] = [filepath_signal, filepath_eyepos]
+            if 'trials' in config:
+                command = python + [os.path.join(SCRIPT_FOLDER, 'batch_render.py'), eye_folder, config['date'],
+                                    '--runs', run, run, '--trials'] + config['trials'] + ['--workers', 1]
+                for option, value in render.items():
+                    if value is not False:
+                        command += ['--' + option.replace('_', '-')] + ([] if value is True else [value])
+                tasks.append(Task('render/run{:02d}'.format(run), 'render', command, inputs=signal_csv[run],
+                                  outputs=[output_folder], params=render))
+
+    censor = config.get('censor')
+    censor_file = session_path('censor_file', 'eye_censor.1D') if censor is not None else None
+    if censor is not None and eye_folder is not None:
+        command = python + [os.path.join(SCRIPT_FOLDER, 'session_censor.py'), eye_folder, censor_file,
+                            '--runs'] + [run for run, _ in runs] + ['--dsets'] + [ss_files[run] for run, _ in runs]
+        for option, value in censor.items():
+            command += ['--' + option.replace('_', '-'), value]
+        extern = path('extern_censor')
+        inputs = [csv for run, _ in runs for csv in signal_csv[run][1:]] + list(ss_files.values())
+        if extern is not None:
+            command += ['--and', extern]
+            inputs.append(extern)
+        tasks.append(Task('censor', 'censor', command + ['--workers', 1], inputs=inputs, outputs=[censor_file],
+                          params=censor))
+
+    afni_script = path('afni_script')
+    if afni_script is not None:
+        inputs = [afni_script] + list(ss_files.values()) + ([censor_file] if censor is not None else [])
+        tasks.append(Task('afni_proc', 'afni_proc', tools['tcsh'] + [afni_script], inputs=inputs,
+                          outputs=[path(key) for key in ('afni_output',) if key in config],
+                          cwd=os.path.dirname(afni_script)))
+    return tasks
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the session pipeline (dcm2niix, skull stripping, graphs, censor, "
+                                                 "afni_proc), skipping the stages whose inputs have not changed.")
+    parser.add_argument('config', help="the session config (json), see the README")
+    parser.add_argument('--workers', type=int, default=4, help="commands running at the same time")
+    parser.add_argument('--force', action='store_true', help="run every stage, even the ones that are up to date")
+    parser.add_argument('--stub-tools', action='store_true',
+                        help="replace dcm2niix, FSL and tcsh by stand-ins (for testing)")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        session_config = json.load(f)
+    folder = os.path.dirname(os.path.abspath(args.config))
+    pipeline = session_tasks(session_config, folder, tool_commands(session_config, args.stub_tools))
+    pipeline_report = run_pipeline(pipeline, folder, args.workers, args.force)
+    print_summary(pipeline_report)
+    if any(entry['status'] in ('failed', 'blocked') for entry in pipeline_report):
+        raise SystemExit(1)
@@ -1,25 +1,52 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.colors import LinearSegmentedColormap
 from matplotlib.lines import Line2D
 from matplotlib.patches import Circle
 import os
 
+from eyepos_heatmap import CumulativeHeatmaps, heatmap_edges, trial_histogram
+from eyepos_io import load_eyepos
+from figure_templates import HeatmapTemplate, SignalGraphTemplate, heatmap_colormap, signal_graph_axes
+from session_events import load_session_events
+from session_paths import run_paths
+import instrumentation
+from instrumentation import instrumented, stage
+
 COLORS = ['r', 'g', 'b', 'c', 'm', 'y']
+FAST_PNG_COMPRESS_LEVEL = 1     # zlib level used by the fast rendering mode (PIL's default is 6)
+
+
+def trial_range_labels(start_trial, end_trial):
+    """Returns the trial range as shown in graph titles and as used in file names."""
+    if start_trial == end_trial:
+        return start_trial, start_trial
+    return "{} - {}".format(start_trial, end_trial), "{}-to-{}".format(start_trial, end_trial)
+
+
+def signal_graph_filename(date, run_num, start_trial, end_trial):
+    pic = trial_range_labels(start_trial, end_trial)[1]
+    return "{}-run{}-signal-graph-trial-{}.png".format(date, run_num, pic)
+
+
+def heatmap_filename(date, run_num, fixation, start_trial, end_trial):
+    pic = trial_range_labels(start_trial, end_trial)[1]
+    return "{}-run{}-eyepos-heatmap-rad-{}-trial-{}.png".format(date, run_num, fixation, pic)
+
 
 # figsize=(7, 4) per trial
-def plot_discrete_graph(trials, data, start, end, title, x_label, y_label, png_name, ttl_pulse_list=None):
+def plot_discrete_graph(trials, event_times, start, end, title, x_label, y_label, png_name, ttl_pulse_list=None):
     plt.rcParams.update({'font.size': 20})
     fig, graph = plt.subplots(figsize=(7 * len(trials), 4))
 
     for trial_index in trials:
-        data_x = data[data['Trial'] == trial_index]['AbsCodeTime'].to_list()
+        data_x = event_times.trial(trial_index)
+        if len(data_x) == 0:
+            continue    # e.g. no reward in this trial; stem cannot draw an empty array
         data_y = [1] * len(data_x)
         graph.stem(data_x, data_y, linefmt=COLORS[trial_index] + '-', markerfmt='o', basefmt=" ",
                    label='Trial {}'.format(trial_index))
 
-    if ttl_pulse_list is not None:
+    if ttl_pulse_list is not None and len(ttl_pulse_list) != 0:
         graph.stem(ttl_pulse_list, [1] * len(ttl_pulse_list), linefmt='k-', markerfmt='o', basefmt=" ",
                    label='TTL between\ntrials')
 
@@ -78,17 +105,133 @@ def plot_continuous_graph(trials, data, start_time, end_time, title, x_label, y_
     plt.close()
 
 
-def plot_everything_in_one_graph(trials, trial_start_data, trial_end_data, baseline_data, stimulus_data,
-                                 reward_data, punish_data, ttl_data, ttl_pulse_data, eye_pos_data, total_offline_time,
-                                 title, png_name):
+def decimate_to_pixels(x, y, x_limits, y_limits, width_px, height_px):
+    """
+    Keeps one sample per occupied pixel of the axes, dropping NaN and samples outside x_limits.
+
+    Samples landing in the same pixel draw the same marker, so the plot looks the same. The lowest and highest
+    sample of every pixel column are always kept, i.e. the min/max envelope of the trace is preserved.
+    """
+    keep = ~np.isnan(y) & (x >= x_limits[0]) & (x <= x_limits[1])
+    x = x[keep]
+    y = y[keep]
+    column = ((x - x_limits[0]) * (width_px / (x_limits[1] - x_limits[0]))).astype(np.int64)
+    row = np.clip((y - y_limits[0]) * (height_px / (y_limits[1] - y_limits[0])), 0, height_px).astype(np.int64)
+    first = np.unique(column * (int(height_px) + 1) + row, return_index=True)[1]
+    first.sort()
+    return x[first], y[first]
+
+
+def interval_step_path(trial_start, trial_end, interval_start, interval_end, low, high):
+    """Exact step path of one trial: low outside [interval_start, interval_end] and high inside it."""
+    if np.isnan(interval_start) or np.isnan(interval_end):
+        return [trial_start, trial_end], [low, low]
+    interval_start = min(max(interval_start, trial_start), trial_end)
+    interval_end = min(max(interval_end, trial_start), trial_end)
+    return ([trial_start, interval_start, interval_start, interval_end, interval_end, trial_end],
+            [low, low, high, high, low, low])
+
+
+def eye_trace(events, trial, trial_start):
+    """Eye position of one trial as plotted in the signal graph: (offline time, deviation shifted up by 1.5)."""
+    eye_pos = events.eye_pos
+    samples = eye_pos.samples(trial, trial_start)
+    return eye_pos.time[samples], np.minimum(eye_pos.values('magnitude', samples), 3.5) + 1.5
+
+
+def signal_event_data(trials, events):
+    """
+    The events of the signal graph, one array (or x/y pair) per artist.
+
+    Intervals are exact step paths of all trials joined by NaN, which breaks the line between trials.
+    """
+    first_trial = trials[0]
+    last_trial = trials[-1]
+    trial_start_data = events.trial_start.between(first_trial, last_trial)
+    trial_end_data = events.trial_end.between(first_trial, last_trial)
+    baseline_start, baseline_end = events.baseline(first_trial, last_trial)
+    stimulus_start, stimulus_end = events.stimulus(first_trial, last_trial)
+
+    baseline_x, baseline_y, stimulus_x, stimulus_y = [], [], [], []
+    for i, trial_index in enumerate(trials):
+        x, y = interval_step_path(trial_start_data[i], trial_end_data[i] + 1, baseline_start[i], baseline_end[i],
+                                  0, 0.4)
+        baseline_x += x + [np.nan]
+        baseline_y += y + [np.nan]
+        x, y = interval_step_path(trial_start_data[i], trial_end_data[i] + 1, stimulus_start[i], stimulus_end[i],
+                                  0.02, 0.8)
+        stimulus_x += x + [np.nan]
+        stimulus_y += y + [np.nan]
+
+    return {
+        'baseline': (baseline_x, baseline_y),
+        'stimulus': (stimulus_x, stimulus_y),
+        'ttl_between_trials': events.ttl_between_trials(first_trial, last_trial),
+        'trial_start': trial_start_data,
+        'trial_end': trial_end_data,
+        'ttl': events.ttl.between(first_trial, last_trial),
+        'reward': events.reward.between(first_trial, last_trial),
+        'punish': events.punish.between(first_trial, last_trial),
+    }
+
+
+@instrumented('compute/signal graph data')
+def fast_signal_graph_data(trials, events, x_limits, y_limits, width_px, height_px):
+    """
+    Everything the fast mode draws: the events of signal_event_data plus the eye trace, decimated to the pixel
+    resolution of the axes (width_px x height_px).
+    """
+    data = signal_event_data(trials, events)
+    traces = [eye_trace(events, trial_index, start) for trial_index, start in zip(trials, data['trial_start'])]
+    data['eye_pos'] = decimate_to_pixels(np.concatenate([x for x, _ in traces]), np.concatenate([y for _, y in traces]),
+                                         x_limits, y_limits, width_px, height_px)
+    return data
+
+
+def axes_size_px(fig, graph, dpi=100):
+    """Size of the axes in pixels once the figure is saved at dpi."""
+    position = graph.get_position()
+    return fig.get_figwidth() * dpi * position.width, fig.get_figheight() * dpi * position.height
+
+
+@instrumented('render/signal graph')
+def plot_everything_in_one_graph(trials, events, title, png_name, fast=False, template=None):
+    """
+    The fast mode draws on a SignalGraphTemplate: template if given, which reuses one figure per number of trials
+    (and always draws the fast mode), otherwise a figure built for this graph only.
+    """
+    first_trial = trials[0]
+    last_trial = trials[-1]
+    trial_start_data = events.trial_start.between(first_trial, last_trial)
+    trial_end_data = events.trial_end.between(first_trial, last_trial)
+    baseline_start, baseline_end = events.baseline(first_trial, last_trial)
+    stimulus_start, stimulus_end = events.stimulus(first_trial, last_trial)
+
+    # graph.set_xlim(trial_start_data[0] - 1000, trial_end_data[-1] + 1000)
+    x_limits = (trial_start_data[0] - 500, trial_end_data[-1] + 500)
+    y_limits = (0, 5.2)
+
+    if fast or template is not None:
+        one_off = template is None
+        if one_off:
+            template = SignalGraphTemplate()
+        page = template.figure(len(trials))
+        data = fast_signal_graph_data(trials, events, x_limits, y_limits, *axes_size_px(page.fig, page.graph))
+        # zlib dominates savefig on these wide images; fast mode trades a larger file for a much faster encode
+        template.render(page, data, x_limits, title, png_name, {'compress_level': FAST_PNG_COMPRESS_LEVEL})
+        if one_off:
+            template.close()
+        return
+
+    # the normal mode draws every trial's events as their own stems, so the number of artists changes per graph
     plt.rcParams.update({'font.size': 20})
     # fig, graph = plt.subplots(figsize=(20 * len(trials), 4))
     fig, graph = plt.subplots(figsize=(50 * len(trials), 8))
 
-    if ttl_pulse_data is not None:
+    ttl_pulse_data = events.ttl_between_trials(first_trial, last_trial)
+    if len(ttl_pulse_data) != 0:
         graph.stem(ttl_pulse_data, [0.1] * len(ttl_pulse_data), linefmt='b-', markerfmt='o', basefmt=" ")
 
-    first_trial = trials[0]
     for trial_index in trials:
         trial_start_data_x = trial_start_data[trial_index - first_trial]
         markerline, stemlines, baseline = graph.stem([trial_start_data_x], [1], linefmt='k-', markerfmt='o',
@@ -96,55 +239,41 @@ def plot_everything_in_one_graph(trials, trial_start_data, trial_end_data, basel
         plt.setp(stemlines, 'linewidth', 3)
 
         trial_end_data_x = trial_end_data[trial_index - first_trial]
-        markerline, stemlines, baseline = graph.stem([trial_end_data_x], [1], linefmt='k--', markerfmt='o', basefmt=" ",
-                                                     label='Trial End')
+        markerline, stemlines, baseline = graph.stem([trial_end_data_x], [1], linefmt='k--', markerfmt='o',
+                                                     basefmt=" ", label='Trial End')
         plt.setp(stemlines, 'linewidth', 4.5)
 
-        ttl_x = ttl_data[ttl_data['Trial'] == trial_index]['AbsCodeTime'].to_list()
-        ttl_y = [0.1] * len(ttl_x)
-        graph.stem(ttl_x, ttl_y, linefmt='b-', markerfmt='o', basefmt=" ", label='TTL')
+        ttl_x = events.ttl.trial(trial_index)
+        if len(ttl_x) != 0:
+            ttl_y = [0.1] * len(ttl_x)
+            graph.stem(ttl_x, ttl_y, linefmt='b-', markerfmt='o', basefmt=" ", label='TTL')
 
-        reward_x = reward_data[reward_data['Trial'] == trial_index]['AbsCodeTime'].to_list()
+        reward_x = events.reward.trial(trial_index)
         if len(reward_x) != 0:
             reward_y = [1] * len(reward_x)
             graph.stem(reward_x, reward_y, linefmt='g-', markerfmt='o', basefmt=" ", label='Reward')
 
-        punish_x = punish_data[punish_data['Trial'] == trial_index]['AbsCodeTime'].to_list()
+        punish_x = events.punish.trial(trial_index)
         if len(punish_x) != 0:
             punish_y = [1] * len(punish_x)
             graph.stem(punish_x, punish_y, linefmt='r-', markerfmt='o', basefmt=" ", label='No Reward')
 
-        eye_pos_magnitude = eye_pos_data.iloc[0:int(eye_pos_data.loc[eye_pos_data['eye_pos{:02d}_magnitude'.format(trial_index)].last_valid_index()]['timestamp']) + 1][['timestamp', 'eye_pos{:02d}_magnitude'.format(trial_index)]]
-        eye_pos_magnitude.loc[eye_pos_magnitude['eye_pos{:02d}_magnitude'.format(trial_index)] > 3.5, 'eye_pos{:02d}_magnitude'.format(trial_index)] = 3.5
-        eye_pos_magnitude['eye_pos{:02d}_magnitude'.format(trial_index)] = eye_pos_magnitude['eye_pos{:02d}_magnitude'.format(trial_index)] + 1.5
-        eye_pos_magnitude['timestamp'] = eye_pos_magnitude['timestamp'] + total_offline_time
-        eye_pos_magnitude = eye_pos_magnitude[eye_pos_magnitude['timestamp'] >= trial_start_data_x]
-
-        graph.scatter(eye_pos_magnitude['timestamp'].to_list(),
-                      eye_pos_magnitude['eye_pos{:02d}_magnitude'.format(trial_index)].to_list(),
-                      marker='o', color='purple', s=2, label='Eye Position')
+        eye_pos_timestamp, eye_pos_magnitude = eye_trace(events, trial_index, trial_start_data_x)
+        graph.scatter(eye_pos_timestamp, eye_pos_magnitude, marker='o', color='purple', s=2, label='Eye Position')
         graph.axhline(y=1.5, color='red', linestyle='--', label='Fixation at 1.5')
 
         continuous_graph_x = np.linspace(trial_start_data_x, trial_end_data_x + 1, 3000)
-        baseline_data_y = np.where((continuous_graph_x >= baseline_data['start'][trial_index - first_trial]) &
-                                   (continuous_graph_x <= baseline_data['end'][trial_index - first_trial]), 0.4, 0)
+        baseline_data_y = np.where((continuous_graph_x >= baseline_start[trial_index - first_trial]) &
+                                   (continuous_graph_x <= baseline_end[trial_index - first_trial]), 0.4, 0)
         graph.plot(continuous_graph_x, baseline_data_y, label='Baseline', color='gray', linewidth=3)
 
-        stimulus_data_y = np.where((continuous_graph_x >= stimulus_data['start'][trial_index - first_trial]) &
-                                   (continuous_graph_x <= stimulus_data['end'][trial_index - first_trial]), 0.8, 0.02)
+        stimulus_data_y = np.where((continuous_graph_x >= stimulus_start[trial_index - first_trial]) &
+                                   (continuous_graph_x <= stimulus_end[trial_index - first_trial]), 0.8, 0.02)
         graph.plot(continuous_graph_x, stimulus_data_y, label='Stimulus', color='orange', linewidth=3)
 
-    graph.set_ylim(0, 5.2)
-    custom_ticks = [0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0]
-    custom_labels = [0, 0.5, 1.0, 0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5]
-    graph.set_yticks(custom_ticks)
-    graph.set_yticklabels(custom_labels)
-
-    # graph.set_xlim(trial_start_data[0] - 1000, trial_end_data[-1] + 1000)
-    graph.set_xlim(trial_start_data[0] - 500, trial_end_data[-1] + 500)
+    signal_graph_axes(graph)
+    graph.set_xlim(*x_limits)
     graph.set_title(title)
-    graph.set_xlabel("Time (ms)")
-    graph.set_ylabel("Signal       Deviation of Fixation (Deg)")
 
     handles, labels = plt.gca().get_legend_handles_labels()
     by_label = dict(zip(labels, handles))
@@ -152,107 +281,37 @@ def plot_everything_in_one_graph(trials, trial_start_data, trial_end_data, basel
     by_label['Trial End'] = Line2D([], [], color='black', linestyle='--', label='Trial End')
     graph.legend(by_label.values(), by_label.keys(), bbox_to_anchor=(1.0, 1.15), loc='upper left')
 
-    graph.grid(False)
-    fig.savefig(png_name, dpi=100, bbox_inches='tight')
+    with stage('save/signal graph'):
+        fig.savefig(png_name, dpi=100, bbox_inches='tight')
     plt.close()
 
 
-def plot_graphs_for_trials(data_file, filepath_eyepos, date, run_num, start_trial, end_trial, output_folder):
+def plot_graphs_for_trials(events, date, run_num, start_trial, end_trial, output_folder, fast=False, template=None):
     if end_trial - start_trial + 1 > 5:
-        raise Exception("Sorry, max trials are 5.\n")
+        raise Exception("Sorry, max trials are 5. Use timeline_tiles.py to view a whole run.\n")
 
-    if start_trial == end_trial:
-        title = start_trial
-        pic = start_trial
-    else:
-        title = "{} - {}".format(start_trial, end_trial)
-        pic = "{}-to-{}".format(start_trial, end_trial)
+    title = trial_range_labels(start_trial, end_trial)[0]
 
-    df = pd.read_csv(data_file)
-    # trials = df['Trial'].unique()
     trials = list(range(start_trial, end_trial + 1))
 
-    reward_rows = df[df['CodeNumber'] == 17][['Trial', 'AbsCodeTime']].reset_index(drop=True)
-    punish_rows = df[df['CodeNumber'] == 15][['Trial', 'AbsCodeTime']].reset_index(drop=True)
-    ttl_rows = df[(df['CodeNumber'] == 11) | (df['CodeNumber'] == 21)][
-        ['Trial', 'AbsCodeTime', 'CodeNumber']].reset_index(drop=True)
-    ttl_between_trials = df[df['Event_Type'] == 'TTL_ITI'][['Trial', 'TTL_pulse_start']].reset_index(drop=True)
-    if start_trial == end_trial:
-        ttl_between_trials = None
-    else:
-        ttl_between_trials = ttl_between_trials[(ttl_between_trials['Trial'] > start_trial) &
-                                                (ttl_between_trials['Trial'] <= end_trial)]['TTL_pulse_start'].to_list()
-
-    trial_start_rows = df[df['CodeNumber'] == 9][['Trial', 'AbsCodeTime']].reset_index(drop=True)
-    trial_end_rows = df[df['CodeNumber'] == 18][['Trial', 'AbsCodeTime']].reset_index(drop=True)
-
-    trial_start_time = trial_start_rows[(trial_start_rows['Trial'] >= start_trial) &
-                                        (trial_start_rows['Trial'] <= end_trial)]['AbsCodeTime'].to_list()
-    trial_end_time = trial_end_rows[(trial_end_rows['Trial'] >= start_trial) &
-                                    (trial_end_rows['Trial'] <= end_trial)]['AbsCodeTime'].to_list()
-    trial_time_data = [list(pair) for pair in zip(trial_start_time, trial_end_time)]
-
-    baseline_rows = df[(df['CodeNumber'] == 24) | (df['CodeNumber'] == 6)][['Trial', 'CodeNumber', 'AbsCodeTime']] \
-        .reset_index(drop=True)
-    baseline_start = baseline_rows[(baseline_rows['Trial'] >= start_trial) &
-                                   (baseline_rows['Trial'] <= end_trial)][::2]['AbsCodeTime'].to_list()
-    baseline_end = baseline_rows[(baseline_rows['Trial'] >= start_trial) &
-                                 (baseline_rows['Trial'] <= end_trial)][1::2]['AbsCodeTime'].to_list()
-
-    stimulus_rows = df[(df['CodeNumber'] == 6) | (df['CodeNumber'] == 18)][
-        ['Trial', 'CodeNumber', 'AbsCodeTime']].reset_index(drop=True)
-    stimulus_start = stimulus_rows[(stimulus_rows['Trial'] >= start_trial) &
-                                   (stimulus_rows['Trial'] <= end_trial)][::2]['AbsCodeTime'].to_list()
-    stimulus_end = stimulus_rows[(stimulus_rows['Trial'] >= start_trial) &
-                                 (stimulus_rows['Trial'] <= end_trial)][1::2]['AbsCodeTime'].to_list()
-
-    df2 = pd.read_csv(filepath_eyepos)
-    df2['timestamp'] = df2.index
-
-    total_offline_time = 0
-    eyepos_end_trial = trials[0] if len(trials) == 1 else trials[-1]
-
-    for trial in range(1, eyepos_end_trial):
-        total_offline_time += len(df2.iloc[0:int(df2.loc[df2['eye_pos{:02d}_magnitude'.format(trial)].last_valid_index()]['timestamp']) + 1])
-
-    eye_pos_mag_list = ['timestamp']
-    for trial in trials:
-        eye_pos_mag_list.append("eye_pos{:02d}_magnitude".format(trial))
-    eye_pos_data = df2[eye_pos_mag_list]
-
-    output_image_name = "{}-run{}-signal-graph-trial-{}.png".format(date, run_num, pic)
+    output_image_name = signal_graph_filename(date, run_num, start_trial, end_trial)
     output_image_path = os.path.join(output_folder, output_image_name)
 
-    plot_everything_in_one_graph(trials, trial_start_time, trial_end_time,
-                                 {'start': baseline_start, 'end': baseline_end},
-                                 {'start': stimulus_start, 'end': stimulus_end},
-                                 reward_rows,
-                                 punish_rows,
-                                 ttl_rows,
-                                 ttl_between_trials,
-                                 eye_pos_data, total_offline_time,
+    plot_everything_in_one_graph(trials, events,
                                  "{} Run {} Signal Graph for trial {}".format(date, run_num, title),
-                                 output_image_path)
+                                 output_image_path, fast, template)
 
 
 def plot_eye_pos_graph_for_trials(eye_pos_filepath, date, run_num, start_trial, end_trial):
     plt.rcParams.update({'font.size': 20})
     fig, graph = plt.subplots(figsize=(50, 6))
 
-    df = pd.read_csv(eye_pos_filepath)
-    df['timestamp'] = df.index
+    eye_pos = load_eyepos(eye_pos_filepath)
 
     trial = start_trial
-    eye_pos_data = df.iloc[0:int(df.loc[df['eye_pos{:02d}_xcoord'.format(trial)].last_valid_index()]['timestamp']) + 1][
-        ['timestamp', 'eye_pos{:02d}_magnitude'.format(trial)]]
-
-    eye_pos_data.loc[
-        eye_pos_data['eye_pos{:02d}_magnitude'.format(trial)] > 10, 'eye_pos{:02d}_magnitude'.format(trial)] = 3.5
+    eye_pos_magnitude = np.where(eye_pos.magnitude(trial) > 10, 3.5, eye_pos.magnitude(trial)) + 1
 
-    eye_pos_data['eye_pos{:02d}_magnitude'.format(trial)] = eye_pos_data['eye_pos{:02d}_magnitude'.format(trial)] + 1
-
-    graph.scatter(eye_pos_data['timestamp'].to_list(), eye_pos_data['eye_pos{:02d}_magnitude'.format(trial)].to_list(),
-                  marker='o', color='purple', s=5)
+    graph.scatter(np.arange(len(eye_pos_magnitude)), eye_pos_magnitude, marker='o', color='purple', s=5)
     # graph.plot(eye_pos_data['timestamp'].to_list(), eye_pos_data['eye_pos{:02d}'.format(trial)].to_list(), color='blue')
     graph.set_xlabel('X-axis')
     graph.set_ylabel('Y-axis')
@@ -261,70 +320,51 @@ def plot_eye_pos_graph_for_trials(eye_pos_filepath, date, run_num, start_trial,
     plt.close()
 
 
-def generate_eye_pos_heatmap(eye_pos_filepath, start_trial, end_trial, bin_size, fixation, date, run_num, output_folder):
-    plt.rcParams.update({'font.size': 20})
-    fig, graph = plt.subplots(figsize=(16, 12))
-
-    if start_trial == end_trial:
-        title = start_trial
-        pic = start_trial
+@instrumented('render/heatmap')
+def generate_eye_pos_heatmap(eye_pos_filepath, start_trial, end_trial, bin_size, fixation, date, run_num, output_folder,
+                             heatmaps=None, template=None):
+    """
+    heatmaps is an optional CumulativeHeatmaps of the run with the same bin_size. When plotting many (overlapping)
+    windows of one run, build it once and pass it to every call, so each trial is only binned once.
+    template is an optional HeatmapTemplate, which reuses one figure per tile size.
+    """
+    title = trial_range_labels(start_trial, end_trial)[0]
+
+    if heatmaps is None:
+        eye_pos = load_eyepos(eye_pos_filepath)
+        with stage('compute/heatmap'):
+            x_edges = heatmap_edges(bin_size)
+            heatmap = sum(trial_histogram(eye_pos.xcoord(trial), eye_pos.ycoord(trial), x_edges)
+                          for trial in range(start_trial, end_trial + 1))
+            total_points = int(eye_pos.trial_lengths(range(start_trial, end_trial + 1)).sum())
     else:
-        title = "{} - {}".format(start_trial, end_trial)
-        pic = "{}-to-{}".format(start_trial, end_trial)
+        if heatmaps.bin_size != bin_size:
+            raise Exception("heatmaps were binned with tile size {}, not {}".format(heatmaps.bin_size, bin_size))
+        heatmap, total_points = heatmaps.histogram(start_trial, end_trial)
 
-    df = pd.read_csv(eye_pos_filepath)
-    df['timestamp'] = df.index
+    heatmap_percent = (heatmap / total_points) * 100
+    full_title = "{} Run {} Eye Position Heatmap (Radius={}, Tile_size={}) for trial {}".format(date, run_num, fixation,
+                                                                                              bin_size, title)
+    output_image_name = heatmap_filename(date, run_num, fixation, start_trial, end_trial)
+    output_image_path = os.path.join(output_folder, output_image_name)
 
-    trials = list(range(start_trial, end_trial + 1))
+    if template is not None:
+        template.render(template.figure(bin_size), heatmap_percent, fixation, full_title, output_image_path)
+        return
 
-    x_coord_list = []
-    y_coord_list = []
+    plt.rcParams.update({'font.size': 20})
+    fig, graph = plt.subplots(figsize=(16, 12))
 
-    for trial_index in trials:
-        eye_pos_data = \
-            df.iloc[0:int(df.loc[df['eye_pos{:02d}_xcoord'.format(trial_index)].last_valid_index()]['timestamp']) + 1][
-                ['timestamp', 'eye_pos{:02d}_xcoord'.format(trial_index), 'eye_pos{:02d}_ycoord'.format(trial_index)]]
-
-        eye_pos_data.loc[eye_pos_data['eye_pos{:02d}_xcoord'.format(trial_index)] > 3.5, 'eye_pos{:02d}_xcoord'.format(
-            trial_index)] = 3.5
-        eye_pos_data.loc[eye_pos_data['eye_pos{:02d}_ycoord'.format(trial_index)] > 3.5, 'eye_pos{:02d}_ycoord'.format(
-            trial_index)] = 3.5
-
-        x_coord_list.append(eye_pos_data['eye_pos{:02d}_xcoord'.format(trial_index)].to_list())
-        y_coord_list.append(eye_pos_data['eye_pos{:02d}_ycoord'.format(trial_index)].to_list())
-
-    # Define color stops (positions must start at 0 and end at 1)
-    positions = [0.0, 0.25, 0.5, 0.75, 1.0]
-    colors = [
-        (1.0, 1.0, 1.0),  # white at 0%
-        (1.0, 1.0, 0.0),  # yellow at 25%
-        (1.0, 0.5, 0.0),  # orange at 50%
-        (1.0, 0.0, 0.0),  # red at 75%
-        (1.0, 0.0, 0.0)  # red at 100%
-    ]
-
-    # Create the colormap
-    custom_cmap = LinearSegmentedColormap.from_list("custom_heatmap", list(zip(positions, colors)))
-
-    # Determine bin edges
-    x_edges = np.arange(-3.5, 3.5 + bin_size, bin_size)
-    y_edges = np.arange(-3.5, 3.5 + bin_size, bin_size)
-
-    x_coord_list = np.concatenate(x_coord_list)
-    y_coord_list = np.concatenate(y_coord_list)
-
-    # Compute 2D histogram (counts in each square)
-    heatmap, xedges, yedges = np.histogram2d(x_coord_list, y_coord_list, bins=[x_edges, y_edges])
-
-    total_points = len(x_coord_list)
-    heatmap_percent = (heatmap / total_points) * 100
+    # Bin edges (counts in each square are indexed [x, y])
+    x_edges = heatmap_edges(bin_size)
+    y_edges = heatmap_edges(bin_size)
 
     # Plot
     im = graph.imshow(
         heatmap_percent.T,  # transpose so x/y axes match visually
         origin='lower',  # so [0,0] is bottom-left
         extent=[x_edges[0], x_edges[-1], y_edges[0], y_edges[-1]],
-        cmap=custom_cmap,  # or your custom colormap or 'hot'
+        cmap=heatmap_colormap(),  # or your custom colormap or 'hot'
         aspect='auto',
         vmin=0,
         vmax=15
@@ -339,14 +379,10 @@ def generate_eye_pos_heatmap(eye_pos_filepath, start_trial, end_trial, bin_size,
     graph.set_ylabel('Y (Deg)')
     
     
-    graph.set_title(
-        "{} Run {} Eye Position Heatmap (Radius={}, Tile_size={}) for trial {}".format(date, run_num, fixation,
-                                                                                       bin_size, title), pad=30)
-                                                                                       
-    output_image_name = "{}-run{}-eyepos-heatmap-rad-{}-trial-{}.png".format(date, run_num, fixation, pic)
-    output_image_path = os.path.join(output_folder, output_image_name)
-    
-    fig.savefig(output_image_path, dpi=100, bbox_inches='tight')
+    graph.set_title(full_title, pad=30)
+
+    with stage('save/heatmap'):
+        fig.savefig(output_image_path, dpi=100, bbox_inches='tight')
     plt.close()
 
 
@@ -356,6 +392,9 @@ if __name__ == '__main__':
     
     tile_size = 0.1             # the tile size in the heatmap
     rad = 0.8                   # another name is fixation, the dotted radius in the heatmap
+    fast = False                # fast rendering mode for the signal graphs (decimated eye trace, batched artists)
+    instrument = False          # write a timing / memory report per run and per session (or set FMRI_INSTRUMENT=1)
+    profile = False             # with instrument, also write a cProfile file per run (or set FMRI_INSTRUMENT=profile)
     
     first_run = 4               # the first run you want to do. 
     last_run = 4                 # last run you want to do. If you only need one run, set this the same as first_run
@@ -366,15 +405,26 @@ if __name__ == '__main__':
     # please make sure that all the csv files are inside "csv" folder, which is inside target_folder
     input_csv_folder = os.path.join(target_folder, "csv")
 
+    if instrument:
+        instrumentation.enable(profile)
+    else:
+        instrumentation.enable_from_env()
+
+    # figures are built once and reused for every image of every run
+    signal_template = SignalGraphTemplate() if fast else None
+    heatmap_template = HeatmapTemplate()
+
     for run_num in range(first_run, last_run+1):     
-        output_image_folder = os.path.join(target_folder, "{}-run{:02d}-output-images".format(target_folder, run_num))  # you can change the name of the output folder
+        # define signal.csv, eye_pos.csv and the output folder (you can change the names in session_paths.run_paths)
+        filepath_signal, filepath_eyepos, output_image_folder = run_paths(target_folder, run_num)
 
         os.makedirs(input_csv_folder, exist_ok=True)
         os.makedirs(output_image_folder, exist_ok=True)
-        
-        # define signal.csv and eye_pos.csv
-        filepath_signal = os.path.join(input_csv_folder, "{}-run{:02d}-signal.csv".format(target_folder, run_num))   
-        filepath_eyepos = os.path.join(input_csv_folder, "{}-run{:02d}-eye_pos.csv".format(target_folder, run_num))
+
+        instrumentation.begin_run("run{:02d}".format(run_num), date=date, fast=fast, tile_size=tile_size, rad=rad)
+
+        # signal.csv is parsed once per run; every graph of the run slices the same events
+        events = load_session_events(filepath_signal, filepath_eyepos)
 
         # the followings are two for loops, one for signal graphs and one for heatmap graphs. 
         # Currently, each image show only one trial. If you want to put multiple trials in one image, you can add a number to trial_end. 
@@ -387,16 +437,25 @@ if __name__ == '__main__':
             
             if trial_end > last_trial:
                 break
-            plot_graphs_for_trials(filepath_signal, filepath_eyepos, date, run_num, trial_start, trial_end, output_image_folder)
+            plot_graphs_for_trials(events, date, run_num, trial_start, trial_end, output_image_folder, fast,
+                                   signal_template)
         
         
+        # every trial is binned once; each window below is the difference of two cumulative histograms
+        heatmaps = CumulativeHeatmaps(events.eye_pos, tile_size)
         for trial in range(first_trial, last_trial+1):
             trial_start = trial
             trial_end = trial+1
             
             if trial_end > last_trial:
                 break
-            generate_eye_pos_heatmap(filepath_eyepos, trial_start, trial_end, tile_size, rad, date, run_num, output_image_folder)
+            generate_eye_pos_heatmap(filepath_eyepos, trial_start, trial_end, tile_size, rad, date, run_num, output_image_folder,
+                                     heatmaps, heatmap_template)
+
+        # output-images/instrumentation.json, plus instrumentation.json.prof when profiling
+        instrumentation.end_run(os.path.join(output_image_folder, instrumentation.REPORT_NAME))
+
+    instrumentation.write_session_summary(os.path.join(target_folder, instrumentation.SUMMARY_NAME))
 
     # plot_eye_pos_graph_for_trials('250605_PIP_25TD0605-run02-eye_pos.csv', date, run_num, 3, 1)
 
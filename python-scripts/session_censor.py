@@ -0,0 +1,112 @@
+import argparse
+import gzip
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from eyepos_censor import censor_trials, load_magnitude_block, write_censor_1Dfile
+from eyepos_io import load_eyepos
+from session_paths import run_paths
+
+
+def nifti_volume_count(path):
+    """
+    Number of volumes (TRs) of a .nii or .nii.gz file, read from its header only.
+
+    A .nii.gz is decompressed only as far as the header, so this is fast even for large runs. dim[4] is the
+    number of volumes; a 3D image counts as one.
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        header = f.read(540)
+
+    for endian in '<>':
+        size = struct.unpack(endian + 'i', header[:4])[0]
+        if size == 348:     # NIfTI-1: dim is 8 int16 at byte 40
+            dim = struct.unpack(endian + '8h', header[40:56])
+            break
+        if size == 540:     # NIfTI-2: dim is 8 int64 at byte 16
+            dim = struct.unpack(endian + '8q', header[16:80])
+            break
+    else:
+        raise Exception("{} is not a NIfTI file!".format(path))
+    return int(dim[4]) if dim[0] >= 4 else 1
+
+
+def read_censor_1Dfile(path):
+    """Reads a one column 0/1 censor file, e.g. the motion / outlier censor written by afni_proc."""
+    values = np.loadtxt(path, comments='#', ndmin=2)
+    if values.shape[1] != 1:
+        raise Exception("{} has {} columns, a censor file has one!".format(path, values.shape[1]))
+    return values[:, 0].astype(int)
+
+
+def run_censor(filepath_eyepos, method, mean_threshold=None, std_dev_threshold=None, fixation=None,
+               percent_threshold=None):
+    """The eye censor of every trial of one run, concatenated like the 1D file of eyepos-threshold-checker.py."""
+    eye_pos = load_eyepos(filepath_eyepos, quantities=('magnitude',))
+    block, lengths = load_magnitude_block(eye_pos, eye_pos.trials)
+    censor = censor_trials(block, lengths, method, mean_threshold=mean_threshold, std_dev_threshold=std_dev_threshold,
+                           fixation=fixation, percent_threshold=percent_threshold)
+    return np.concatenate(censor) if censor else np.zeros(0, dtype=int)
+
+
+def session_censor(target_folder, runs, dsets, output, method, mean_threshold=None, std_dev_threshold=None,
+                   fixation=None, percent_threshold=None, extern_censor=None, workers=None):
+    """
+    Writes one censor file for afni_proc (-regress_censor_extern) covering every run of the session.
+
+    runs are the run numbers of the csv files and dsets the matching EPI files, in the order given to afni_proc
+    (-dsets). The eye censor of every run is computed on a process pool and must have as many TRs as its dataset.
+    With extern_censor (e.g. the motion / outlier censor of afni_proc), a TR is only kept if both keep it.
+    Returns the censor of every run.
+    """
+    if len(runs) != len(dsets):
+        raise Exception("{} runs but {} datasets!".format(len(runs), len(dsets)))
+    volumes = [nifti_volume_count(dset) for dset in dsets]
+
+    eyepos_files = [run_paths(target_folder, run_num)[1] for run_num in runs]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        censors = list(executor.map(run_censor, eyepos_files, *[[value] * len(runs) for value in
+                                    (method, mean_threshold, std_dev_threshold, fixation, percent_threshold)]))
+
+    mismatches = ["run {}: {} TRs in the eye censor, {} volumes in {}".format(run_num, len(censor), n, dset)
+                  for run_num, censor, n, dset in zip(runs, censors, volumes, dsets) if len(censor) != n]
+    if mismatches:
+        raise Exception("TR counts do not match!\n" + "\n".join(mismatches))
+
+    if extern_censor is not None:
+        extern = read_censor_1Dfile(extern_censor)
+        if len(extern) != sum(volumes):
+            raise Exception("{} has {} TRs, the runs have {}!".format(extern_censor, len(extern), sum(volumes)))
+        starts = np.cumsum([0] + volumes)
+        censors = [censor & extern[starts[i]:starts[i + 1]] for i, censor in enumerate(censors)]
+
+    write_censor_1Dfile(output, censors)
+    return censors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the eye censor of a whole session for afni_proc.")
+    parser.add_argument('target_folder', help="the session folder that contains the csv folder")
+    parser.add_argument('output', help="the censor 1D file, for -regress_censor_extern")
+    parser.add_argument('--runs', type=int, nargs='+', required=True, help="run numbers, in the order of --dsets")
+    parser.add_argument('--dsets', nargs='+', required=True, help="the EPI files given to afni_proc (-dsets)")
+    parser.add_argument('--method', choices=['mean', 'percentage'], required=True)
+    parser.add_argument('--mean-threshold', type=float)
+    parser.add_argument('--std-dev-threshold', type=float)
+    parser.add_argument('--fixation', type=float)
+    parser.add_argument('--percent-threshold', type=float)
+    parser.add_argument('--and', dest='extern_censor', default=None,
+                        help="an existing censor file (e.g. motion / outliers) to combine with")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    run_censors = session_censor(args.target_folder, args.runs, args.dsets, args.output, args.method,
+                                 args.mean_threshold, args.std_dev_threshold, args.fixation, args.percent_threshold,
+                                 args.extern_censor, args.workers)
+    for run_num, censor in zip(args.runs, run_censors):
+        print("run {}: {} TRs, {} censored".format(run_num, len(censor), int((censor == 0).sum())))
+    print("written to {}".format(os.path.abspath(args.output)))
@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+from eyepos_io import load_eyepos
+from instrumentation import stage
+
+# MonkeyLogic code numbers written by combineMonkeyLogicCodes (downstream.m)
+TRIAL_START = 9
+TTL_ONSET = 11
+BASELINE_ONSET = 24
+TTL_PULSE = 21
+REWARD = 17
+JUICE = 8
+STIMULUS_ONSET = 6
+PUNISH = 15
+TRIAL_END = 18
+TTL_ITI = 52
+
+
+class EventTimes:
+    """
+    Sorted event times grouped by trial (CSR layout).
+
+    The events of trial t are times[offsets[t]:offsets[t + 1]], so any trial range is a single slice.
+    """
+
+    def __init__(self, trials, times, max_trial):
+        order = np.lexsort((times, trials))
+        self.times = np.asarray(times, dtype=np.float64)[order]
+        trials = np.asarray(trials, dtype=np.int64)[order]
+        self.offsets = np.searchsorted(trials, np.arange(max_trial + 2), side='left')
+
+    def between(self, start_trial, end_trial):
+        start_trial = min(max(start_trial, 0), len(self.offsets) - 1)
+        end_trial = min(max(end_trial + 1, 0), len(self.offsets) - 1)
+        return self.times[self.offsets[start_trial]:self.offsets[end_trial]]
+
+    def trial(self, trial):
+        return self.between(trial, trial)
+
+    def first(self, trial):
+        """First event of a trial, NaN if the trial has none."""
+        times = self.trial(trial)
+        return times[0] if len(times) else np.nan
+
+
+class SessionEvents:
+    """
+    All events of one run, parsed once from signal.csv.
+
+    Events are grouped by code number, with code 11 and 21 merged as TTL, and TTL_ITI rows kept apart
+    with their TTL_pulse_start. Baseline (24 -> 6) and stimulus (6 -> 18) intervals are paired per trial.
+    If the run's eye_pos data is given, its time axis (EyePosRun.time) lines the eye samples up with AbsCodeTime.
+    """
+
+    def __init__(self, signal_df, eye_pos=None):
+        self.eye_pos = eye_pos
+
+        trial_column = signal_df['Trial'].to_numpy(dtype=np.int64)
+        self.trials = np.unique(trial_column)
+        max_trial = int(self.trials.max(initial=0))
+
+        codes = signal_df['CodeNumber'].to_numpy(dtype=np.float64)
+        times = signal_df['AbsCodeTime'].to_numpy(dtype=np.float64)
+        self.codes = {}
+        for code in np.unique(codes[~np.isnan(codes)]):
+            rows = codes == code
+            self.codes[int(code)] = EventTimes(trial_column[rows], times[rows], max_trial)
+
+        empty = EventTimes([], [], max_trial)
+        self.ttl = EventTimes(*self._merge(trial_column, codes, times, [TTL_ONSET, TTL_PULSE]), max_trial)
+        iti_rows = (signal_df['Event_Type'] == 'TTL_ITI').to_numpy()
+        self.ttl_iti = EventTimes(trial_column[iti_rows], signal_df['TTL_pulse_start'].to_numpy(dtype=np.float64)[iti_rows],
+                                  max_trial)
+
+        self.trial_start = self.codes.get(TRIAL_START, empty)
+        self.trial_end = self.codes.get(TRIAL_END, empty)
+        self.reward = self.codes.get(REWARD, empty)
+        self.punish = self.codes.get(PUNISH, empty)
+
+        # one interval per trial, indexed by trial number; NaN when a code is missing
+        baseline_onset = self.codes.get(BASELINE_ONSET, empty)
+        stimulus_onset = self.codes.get(STIMULUS_ONSET, empty)
+        self.baseline_start = np.full(max_trial + 1, np.nan)
+        self.baseline_end = np.full(max_trial + 1, np.nan)
+        self.stimulus_start = np.full(max_trial + 1, np.nan)
+        self.stimulus_end = np.full(max_trial + 1, np.nan)
+        for trial in self.trials:
+            self.baseline_start[trial] = baseline_onset.first(trial)
+            self.baseline_end[trial] = self._first_after(stimulus_onset.trial(trial), self.baseline_start[trial])
+            self.stimulus_start[trial] = self.baseline_end[trial]
+            self.stimulus_end[trial] = self._first_after(self.trial_end.trial(trial), self.stimulus_start[trial])
+
+    @staticmethod
+    def _merge(trial_column, codes, times, code_list):
+        rows = np.isin(codes, code_list)
+        return trial_column[rows], times[rows]
+
+    @staticmethod
+    def _first_after(times, start):
+        later = times[times >= start] if not np.isnan(start) else times
+        return later[0] if len(later) else np.nan
+
+    def baseline(self, start_trial, end_trial):
+        return self.baseline_start[start_trial:end_trial + 1], self.baseline_end[start_trial:end_trial + 1]
+
+    def stimulus(self, start_trial, end_trial):
+        return self.stimulus_start[start_trial:end_trial + 1], self.stimulus_end[start_trial:end_trial + 1]
+
+    def ttl_between_trials(self, start_trial, end_trial):
+        """TTL pulses recorded between trials, i.e. in the ITI before every trial after the first one."""
+        return self.ttl_iti.between(start_trial + 1, end_trial)
+
+
+def load_session_events(signal_filepath, eyepos_filepath=None):
+    eye_pos = load_eyepos(eyepos_filepath) if eyepos_filepath is not None else None
+    with stage('load/signal csv'):
+        signal_df = pd.read_csv(signal_filepath)
+    with stage('index/session events'):
+        return SessionEvents(signal_df, eye_pos)
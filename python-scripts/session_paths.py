@@ -0,0 +1,30 @@
+import os
+import re
+
+
+def run_paths(target_folder, run_num):
+    """
+    Returns (signal csv, eye_pos csv, output image folder) of a run inside a session folder.
+
+    The file names start with the name of the session folder, so target_folder may also be a path to it.
+    """
+    session = os.path.basename(os.path.normpath(target_folder))
+    input_csv_folder = os.path.join(target_folder, "csv")
+    filepath_signal = os.path.join(input_csv_folder, "{}-run{:02d}-signal.csv".format(session, run_num))
+    filepath_eyepos = os.path.join(input_csv_folder, "{}-run{:02d}-eye_pos.csv".format(session, run_num))
+    output_image_folder = os.path.join(target_folder, "{}-run{:02d}-output-images".format(session, run_num))  # you can change the name of the output folder
+    return filepath_signal, filepath_eyepos, output_image_folder
+
+
+def run_csv_files(target_folder):
+    """{run number: {'signal' or 'eye_pos': (path, mtime_ns, size)}} of the csv files of the session."""
+    session = os.path.basename(os.path.normpath(target_folder))
+    pattern = re.compile(re.escape(session) + r'-run(\d+)-(signal|eye_pos)\.csv$')
+    csv_folder = os.path.join(target_folder, 'csv')
+    runs = {}
+    for entry in os.scandir(csv_folder) if os.path.isdir(csv_folder) else []:
+        match = pattern.match(entry.name)
+        if match:
+            stat = entry.stat()
+            runs.setdefault(int(match.group(1)), {})[match.group(2)] = (entry.path, stat.st_mtime_ns, stat.st_size)
+    return runs
@@ -0,0 +1,303 @@
+import argparse
+import math
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+from eyepos_censor import TR_SAMPLES
+from eyepos_io import load_eyepos
+
+END_OF_STREAM = 'END'
+POLL_INTERVAL = 0.05    # seconds between reads of a file that is being appended to
+
+
+class StreamingCensor:
+    """
+    Censors eye samples as they arrive, with the same result as censor_trials on the finished csv.
+
+    Per TR it keeps the number of samples, the number of valid samples, the sum and sum of squares of the valid
+    magnitudes (shifted by the first one, so the std does not lose precision) and the number of samples inside
+    the fixation radius, so every sample costs O(1). A value is emitted through on_tr(trial, tr, value, stats) as
+    soon as the 1250th sample of a TR arrives, NaN included, so a lost eye is censored without delay; the last
+    (partial) TR of a trial is emitted when the next trial starts.
+
+    The csv stops at the last valid sample of a trial, so TRs after it do not exist there. When a trial ends, the
+    TRs emitted after its last valid sample are taken back through on_retract(trial, n), which keeps the finished
+    result the same as censor_trials.
+    """
+
+    def __init__(self, method, mean_threshold=None, std_dev_threshold=None, fixation=None, percent_threshold=None,
+                 on_tr=None, on_retract=None):
+        if method == 'mean':
+            if mean_threshold is None or std_dev_threshold is None:
+                raise Exception("mean_threshold or std_dev_threshold cannot be empty!")
+        elif method == 'percentage':
+            if fixation is None or percent_threshold is None:
+                raise Exception("Fixation or percent_threshold cannot be empty!")
+        else:
+            raise Exception("Invalid method!")
+        self.method = method
+        self.mean_threshold = mean_threshold
+        self.std_dev_threshold = std_dev_threshold
+        self.fixation = fixation
+        self.percent_threshold = percent_threshold
+        self.on_tr = on_tr
+        self.on_retract = on_retract
+        self.values = {}    # trial: [censor value per TR]
+        self.trial = None
+        self.tr = 0
+        self.valid_trs = 0      # TRs of the trial up to the last one with a valid sample
+        self._reset_tr()
+
+    def _reset_tr(self):
+        self.samples = 0        # samples of the TR so far, NaN included
+        self.count = 0          # valid samples
+        self.shift = 0.0
+        self.total = 0.0        # sum of (x - shift)
+        self.total_sq = 0.0     # sum of (x - shift) ** 2
+        self.within = 0         # samples below the fixation radius
+
+    def add(self, trial, magnitude):
+        if trial != self.trial:
+            self.end_trial()
+            self.trial = trial
+            self.values[trial] = []
+        if not math.isnan(magnitude):
+            if self.count == 0:
+                self.shift = magnitude
+            deviation = magnitude - self.shift
+            self.count += 1
+            self.total += deviation
+            self.total_sq += deviation * deviation
+            self.within += magnitude < self.fixation if self.fixation is not None else 0
+            self.valid_trs = self.tr + 1
+        self.samples += 1
+        if self.samples == TR_SAMPLES:
+            self._emit()
+
+    def end_trial(self):
+        """Emits the last, partial TR of the current trial and takes back the TRs after its last valid sample."""
+        if self.trial is not None:
+            if self.count:
+                self._emit()
+            trailing = self.tr - self.valid_trs
+            if trailing:
+                del self.values[self.trial][-trailing:]
+                if self.on_retract is not None:
+                    self.on_retract(self.trial, trailing)
+        self._reset_tr()
+        self.tr = 0
+        self.valid_trs = 0
+
+    def close(self):
+        self.end_trial()
+        self.trial = None
+
+    def _emit(self):
+        if self.method == 'mean':
+            mean = self.shift + self.total / self.count if self.count else math.nan
+            if self.count > 1:
+                variance = (self.total_sq - self.total * self.total / self.count) / (self.count - 1)
+                std = math.sqrt(max(variance, 0.0))
+            else:
+                std = math.nan
+            # NaN statistics compare False, so the TR is censored, as in censor_trials
+            value = int(mean < self.mean_threshold and std < self.std_dev_threshold)
+            stats = {'mean': mean, 'std': std}
+        else:
+            # the rate is always over a full TR, even for the last partial one
+            rate = self.within / TR_SAMPLES
+            value = int(rate > self.percent_threshold)
+            stats = {'within_fixation': rate}
+        self.values[self.trial].append(value)
+        if self.on_tr is not None:
+            self.on_tr(self.trial, self.tr, value, stats)
+        self.tr += 1
+        self._reset_tr()
+
+
+def parse_sample(line):
+    """
+    Parses one streamed sample, 'trial,magnitude' or 'trial,xcoord,ycoord'. Returns (trial, magnitude) or None
+    for blank and header lines. Values are rounded to float32 like the eye_pos cache, so both give the same censor.
+    """
+    fields = line.strip().split(',')
+    if len(fields) < 2 or not fields[0].strip().lstrip('-').isdigit():
+        return None
+    values = [float(field) if field.strip() else math.nan for field in fields[1:3]]
+    magnitude = values[0] if len(values) == 1 else math.hypot(values[0], values[1])
+    return int(fields[0]), float(np.float32(magnitude))
+
+
+def follow_file(path, idle_timeout=None, poll_interval=POLL_INTERVAL):
+    """
+    Yields the lines of a file while it is being appended to, like tail -f, from its first line.
+
+    Stops at an END line, or when nothing was appended for idle_timeout seconds (None waits forever).
+    """
+    while not os.path.exists(path):
+        time.sleep(poll_interval)
+    with open(path) as f:
+        buffer = ''
+        last_data = time.monotonic()
+        while True:
+            chunk = f.read()
+            if chunk:
+                last_data = time.monotonic()
+                buffer += chunk
+                *lines, buffer = buffer.split('\n')
+                for line in lines:
+                    if line.strip() == END_OF_STREAM:
+                        return
+                    yield line
+            elif idle_timeout is not None and time.monotonic() - last_data > idle_timeout:
+                if buffer:
+                    yield buffer
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+def socket_lines(port=None, unix_path=None):
+    """Listens on localhost:port (or a unix socket) for one sender and yields its lines until it disconnects."""
+    if unix_path is not None:
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(unix_path)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(('127.0.0.1', port))
+    server.listen(1)
+    try:
+        connection, _ = server.accept()
+        with connection, connection.makefile('r') as stream:
+            for line in stream:
+                if line.strip() == END_OF_STREAM:
+                    return
+                yield line
+    finally:
+        server.close()
+        if unix_path is not None and os.path.exists(unix_path):
+            os.remove(unix_path)
+
+
+def stream_censor(lines, output, method, mean_threshold=None, std_dev_threshold=None, fixation=None,
+                  percent_threshold=None, verbose=True):
+    """
+    Censors a stream of sample lines, writing every TR to the 1D file as soon as it is decided.
+
+    A TR without eye signal is written (censored) as soon as it ends. The ones after the last valid sample of a
+    trial are removed from the file again when the trial ends, so the finished file has the same lines as
+    generate_eyepos_magnitude_censor_1Dfile over all streamed trials. Returns {trial: [censor value per TR]}.
+    """
+    with open(output, 'w') as f:
+        line_starts = []    # file position of every line of the current trial
+
+        def on_tr(trial, tr, value, stats):
+            if tr == 0:
+                line_starts.clear()
+            line_starts.append(f.tell())
+            f.write("{}\n".format(value))
+            f.flush()
+            if verbose:
+                details = ', '.join('{} {:.3f}'.format(name, stat) for name, stat in stats.items())
+                print("trial {} TR {}: {}{} ({})".format(trial, tr + 1, value, '' if value else '  CENSORED', details),
+                      file=sys.stderr, flush=True)
+
+        def on_retract(trial, n):
+            f.seek(line_starts[-n])
+            f.truncate()
+            f.flush()
+            del line_starts[-n:]
+            if verbose:
+                print("trial {}: {} TRs after the last eye sample removed".format(trial, n), file=sys.stderr,
+                      flush=True)
+
+        censor = StreamingCensor(method, mean_threshold, std_dev_threshold, fixation, percent_threshold, on_tr,
+                                 on_retract)
+        for line in lines:
+            sample = parse_sample(line)
+            if sample is not None:
+                censor.add(*sample)
+        censor.close()
+    return censor.values
+
+
+def replay_lines(eyepos_csv, start_trial=None, end_trial=None):
+    """The samples of a finished eye_pos csv as stream lines ('trial,magnitude'), e.g. to test a live setup."""
+    eye_pos = load_eyepos(eyepos_csv)
+    for trial in eye_pos.trials:
+        if (start_trial is None or trial >= start_trial) and (end_trial is None or trial <= end_trial):
+            for magnitude in eye_pos.magnitude(trial):
+                yield "{},{}\n".format(trial, '' if np.isnan(magnitude) else repr(float(magnitude)))
+
+
+def replay(eyepos_csv, destination, speed=None, port=None, unix_path=None):
+    """Sends a finished eye_pos csv to a file (appending) or socket at speed times real time (None: at once)."""
+    if port is not None or unix_path is not None:
+        sender = socket.create_connection(('127.0.0.1', port)) if unix_path is None else socket.socket(socket.AF_UNIX)
+        if unix_path is not None:
+            sender.connect(unix_path)
+        out = sender.makefile('w')
+    else:
+        sender = None
+        out = open(destination, 'a')
+    try:
+        start = time.monotonic()
+        for i, line in enumerate(replay_lines(eyepos_csv)):
+            out.write(line)
+            if speed is not None and i % 50 == 0:
+                out.flush()
+                # 1 sample per ms at 1 kHz
+                delay = i / (1000 * speed) - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        out.write(END_OF_STREAM + '\n')
+    finally:
+        out.close()
+        if sender is not None:
+            sender.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Censor eye samples while the scan is running.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    watch = subparsers.add_parser('watch', help="censor a live stream of 'trial,magnitude' (or 'trial,x,y') lines")
+    watch.add_argument('output', help="the censor 1D file, written TR by TR")
+    source = watch.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help="a file that is being appended to")
+    source.add_argument('--port', type=int, help="listen on this localhost TCP port")
+    source.add_argument('--unix', help="listen on this unix socket")
+    watch.add_argument('--method', choices=['mean', 'percentage'], required=True)
+    watch.add_argument('--mean-threshold', type=float)
+    watch.add_argument('--std-dev-threshold', type=float)
+    watch.add_argument('--fixation', type=float)
+    watch.add_argument('--percent-threshold', type=float)
+    watch.add_argument('--idle-timeout', type=float, default=None,
+                       help="stop when the file has not grown for this many seconds (default: wait for an END line)")
+    watch.add_argument('--quiet', action='store_true', help="do not print every TR")
+
+    send = subparsers.add_parser('replay', help="stream a finished eye_pos csv, to test a live setup")
+    send.add_argument('eyepos_csv')
+    target = send.add_mutually_exclusive_group(required=True)
+    target.add_argument('--file')
+    target.add_argument('--port', type=int)
+    target.add_argument('--unix')
+    send.add_argument('--speed', type=float, default=None, help="times real time (default: as fast as possible)")
+    args = parser.parse_args()
+
+    if args.command == 'watch':
+        if args.file is not None:
+            sample_lines = follow_file(args.file, args.idle_timeout)
+        else:
+            sample_lines = socket_lines(args.port, args.unix)
+        stream_censor(sample_lines, args.output, args.method, args.mean_threshold, args.std_dev_threshold,
+                      args.fixation, args.percent_threshold, not args.quiet)
+    else:
+        replay(args.eyepos_csv, args.file, args.speed, args.port, args.unix)
@@ -0,0 +1,131 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from session_events import (BASELINE_ONSET, JUICE, PUNISH, REWARD, STIMULUS_ONSET, TRIAL_END, TRIAL_START, TTL_ITI,
+                            TTL_ONSET, TTL_PULSE)
+from session_paths import run_paths
+
+# same mapping as EVENTTYPE_LIST in combineMonkeyLogicCodes (downstream.m)
+EVENT_TYPES = {TRIAL_START: 'Trial_Start', TTL_ONSET: 'TTL_onset', BASELINE_ONSET: 'Baseline_onset',
+               TTL_PULSE: 'TTL_pulse', REWARD: 'Reward', JUICE: 'Juice', STIMULUS_ONSET: 'Stimulus_onset',
+               PUNISH: 'Punish', TRIAL_END: 'Trial_End', TTL_ITI: 'TTL_ITI'}
+SIGNAL_HEADER = 'Trial,AbsCodeTime,CodeNumber,Event_Type,TTL_pulse_start,MissingCode,TotalFixationDuration\n'
+TR_MS = 1250            # the scanner sends a TTL pulse every TR
+TTL_WIDTH_MS = 10
+
+
+def trial_codes(rng, record_ms, iti_ms, reward_rate):
+    """
+    Behavioral codes of one trial as [(time in the trial record (ms), code)] plus the baseline and stimulus
+    fixation times. The record starts with the inter-trial interval, then the trial runs until Trial_End.
+    """
+    start = iti_ms * rng.uniform(0.8, 1.2)
+    body = record_ms - start
+    baseline_fixation = round(0.3 * body * rng.uniform(0.9, 1.1))
+    stimulus_fixation = round(0.4 * body * rng.uniform(0.9, 1.1))
+    baseline_onset = start + rng.uniform(50, 150)
+    stimulus_onset = baseline_onset + baseline_fixation
+    outcome = stimulus_onset + stimulus_fixation
+    codes = [(start, TRIAL_START), (baseline_onset, BASELINE_ONSET), (stimulus_onset, STIMULUS_ONSET)]
+    if rng.random() < reward_rate:
+        codes += [(outcome, REWARD), (outcome + rng.uniform(1, 5), JUICE)]
+    else:
+        codes.append((outcome, PUNISH))
+    codes.append((record_ms - rng.uniform(20, 60), TRIAL_END))
+    return codes, baseline_fixation, stimulus_fixation
+
+
+def eye_trace(rng, n_samples, fixation_sd=0.3, saccade_rate=0.5, sample_rate=1000):
+    """
+    Eye position in degrees around the fixation point: jitter, a slow drift and saccades away from the centre.
+
+    saccade_rate is in saccades per second; each one holds a point 1.5 to 4 degrees away for 100 to 400 ms.
+    """
+    x = rng.normal(0, fixation_sd, n_samples) + np.cumsum(rng.normal(0, 0.002, n_samples))
+    y = rng.normal(0, fixation_sd, n_samples) + np.cumsum(rng.normal(0, 0.002, n_samples))
+    n_saccades = rng.poisson(saccade_rate * n_samples / sample_rate)
+    for start in rng.integers(0, max(n_samples, 1), n_saccades):
+        end = start + int(rng.uniform(0.1, 0.4) * sample_rate)
+        angle = rng.uniform(0, 2 * np.pi)
+        distance = rng.uniform(1.5, 4)
+        x[start:end] += distance * np.cos(angle)
+        y[start:end] += distance * np.sin(angle)
+    return x, y
+
+
+def format_g(value):
+    # MATLAB's %g, as used by fprintf in combineMonkeyLogicCodes
+    return '%g' % value
+
+
+def generate_run(signal_path, eyepos_path, n_trials=20, trial_ms=12000, sample_rate=1000, iti_ms=1500,
+                 reward_rate=0.7, seed=0):
+    """
+    Writes a synthetic signal.csv and the matching wide eye_pos.csv of one run.
+
+    Files follow combineMonkeyLogicCodes (downstream.m) and write_eyepos_to_csv (plotEyepos.m), including the
+    blank line before every TTL_ITI row and the NaN padding. Like the MATLAB export, the offset of each trial is its
+    number of analog samples, so the Python scripts only line up eye positions and codes at 1000 Hz.
+    """
+    rng = np.random.default_rng(seed)
+    record_ms = trial_ms * rng.uniform(0.85, 1.15, n_trials)
+    n_samples = np.round(record_ms * sample_rate / 1000).astype(np.int64)
+    tr_phase = rng.uniform(0, TR_MS)
+
+    offset = 0
+    with open(signal_path, 'w') as f:
+        f.write(SIGNAL_HEADER)
+        for trial in range(1, n_trials + 1):
+            codes, baseline_fixation, stimulus_fixation = trial_codes(rng, record_ms[trial - 1], iti_ms, reward_rate)
+            trial_start = codes[0][0] + offset
+            trial_end = codes[-1][0] + offset
+
+            # scanner pulses during this record: the ones inside the trial are coded, the rest are TTL_ITI rows
+            first_pulse = tr_phase + TR_MS * np.ceil((offset - tr_phase) / TR_MS)
+            pulses = np.arange(first_pulse, offset + n_samples[trial - 1], TR_MS)
+            pulses = np.round(pulses)
+            in_trial = (pulses >= trial_start) & (pulses <= trial_end)
+            for pulse in pulses[~in_trial]:
+                f.write('\n%d,,,%s,%s,%d,\n' % (trial, EVENT_TYPES[TTL_ITI], format_g(pulse), TTL_ITI))
+            for i, pulse in enumerate(pulses[in_trial]):
+                codes.append((pulse - offset + rng.uniform(0, TTL_WIDTH_MS), TTL_ONSET if i == 0 else TTL_PULSE))
+
+            for time, code in sorted(codes):
+                fixation = {BASELINE_ONSET: baseline_fixation, STIMULUS_ONSET: stimulus_fixation}.get(code)
+                f.write('%d,%s,%d,%s,,,%s\n' % (trial, format_g(round(time + offset, 3)), code, EVENT_TYPES[code],
+                                               '' if fixation is None else format_g(fixation)))
+            offset += n_samples[trial - 1]
+
+    data = np.full((int(n_samples.max()), 3 * n_trials), np.nan)
+    columns = []
+    for trial in range(1, n_trials + 1):
+        x, y = eye_trace(rng, n_samples[trial - 1], sample_rate=sample_rate)
+        data[:len(x), 3 * trial - 3] = x
+        data[:len(x), 3 * trial - 2] = y
+        data[:len(x), 3 * trial - 1] = np.hypot(x, y)
+        columns += ['eye_pos{:02d}_{}'.format(trial, quantity) for quantity in ('xcoord', 'ycoord', 'magnitude')]
+    pd.DataFrame(data, columns=columns).to_csv(eyepos_path, index=False, float_format='%.15g', na_rep='NaN')
+
+
+def generate_session(target_folder, n_runs=1, n_trials=20, trial_ms=12000, sample_rate=1000, seed=0):
+    """Writes synthetic runs into target_folder/csv with the file names plot_graphs.py expects."""
+    os.makedirs(os.path.join(target_folder, 'csv'), exist_ok=True)
+    for run_num in range(1, n_runs + 1):
+        filepath_signal, filepath_eyepos, _ = run_paths(target_folder, run_num)
+        generate_run(filepath_signal, filepath_eyepos, n_trials, trial_ms, sample_rate, seed=seed + run_num)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic session (signal.csv and eye_pos.csv per run).")
+    parser.add_argument('target_folder', help="the session folder to create; the csv files go to its csv folder")
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--trials', type=int, default=20, help="trials per run")
+    parser.add_argument('--trial-ms', type=float, default=12000, help="mean length of a trial record in ms")
+    parser.add_argument('--sample-rate', type=float, default=1000, help="eye position sample rate in Hz")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generate_session(args.target_folder, args.runs, args.trials, args.trial_ms, args.sample_rate, args.seed)
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from eyepos_censor import TR_SAMPLES, censor_trials
+from streaming_censor import StreamingCensor, stream_censor
+
+PARAMS = {'method': 'percentage', 'fixation': 1.0, 'percent_threshold': 0.8}
+
+
+def trial_samples(rng, pieces):
+    """Magnitudes of one trial from (n samples, valid) pieces, rounded to float32 like the stream."""
+    return np.concatenate([rng.uniform(0, 1.2, n).astype(np.float32) if valid else np.full(n, np.nan, np.float32)
+                           for n, valid in pieces]).astype(np.float64)
+
+
+class StreamingCensorTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # trial 1 loses the eye for 4 TRs in the middle and for the last 3000 samples
+        self.trials = {1: trial_samples(rng, [(1000, True), (5000, False), (500, True), (3000, False)]),
+                       2: trial_samples(rng, [(2000, True)])}
+
+    def lines(self):
+        return ["{},{}\n".format(trial, '' if np.isnan(value) else repr(float(value)))
+                for trial, values in self.trials.items() for value in values]
+
+    def test_a_long_nan_gap_is_censored_without_delay(self):
+        emitted = []
+        fed = [0]
+        censor = StreamingCensor(on_tr=lambda trial, tr, value, stats: emitted.append((trial, tr, value, fed[0])),
+                                 **PARAMS)
+        for value in self.trials[1]:
+            fed[0] += 1
+            censor.add(1, value)
+
+        # every full TR is emitted by its own 1250th sample, also the ones without any valid sample
+        self.assertEqual([(tr, samples) for _, tr, _, samples in emitted],
+                         [(tr, (tr + 1) * TR_SAMPLES) for tr in range(len(self.trials[1]) // TR_SAMPLES)])
+        self.assertEqual([value for _, tr, value, _ in emitted if 1 <= tr <= 3], [0, 0, 0])
+
+    def test_finished_file_matches_the_batch_censor(self):
+        lengths = np.array([np.flatnonzero(~np.isnan(values))[-1] + 1 for values in self.trials.values()])
+        block = np.full((len(lengths), -(-lengths.max() // TR_SAMPLES) * TR_SAMPLES), np.nan)
+        for i, values in enumerate(self.trials.values()):
+            block[i, :lengths[i]] = values[:lengths[i]]
+        expected = np.concatenate(censor_trials(block, lengths, **PARAMS))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'censor.1D')
+            values = stream_censor(self.lines(), output, verbose=False, **PARAMS)
+            written = np.loadtxt(output, dtype=int)
+
+        np.testing.assert_array_equal(written, expected)
+        np.testing.assert_array_equal(np.concatenate([values[1], values[2]]), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
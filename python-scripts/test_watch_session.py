@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+
+from batch_render import MANIFEST_NAME, enumerate_jobs, render_batch
+from session_paths import run_paths
+from synthetic_session import generate_run, generate_session
+from watch_session import SessionWatcher
+
+DATE = '2025-07-10'
+TRIALS = 3
+
+
+def read_images(output_folder):
+    images = {}
+    for name in sorted(os.listdir(output_folder)):
+        with open(os.path.join(output_folder, name), 'rb') as f:
+            images[name] = f.read()
+    return images
+
+
+class SessionWatcherTest(unittest.TestCase):
+
+    def test_edited_csv_is_rendered_from_the_new_data(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            target_folder = os.path.join(tmp, 'sess0001')
+            generate_session(target_folder, n_trials=TRIALS, trial_ms=3000, seed=0)
+            filepath_signal, filepath_eyepos, output_folder = run_paths(target_folder, 1)
+
+            watcher = SessionWatcher(target_folder, DATE, workers=2, debounce=0)
+            try:
+                watcher.process_run(1)
+                before = read_images(output_folder)
+                # MATLAB exports the run again with other data while the workers are still alive
+                generate_run(filepath_signal, filepath_eyepos, n_trials=TRIALS, trial_ms=3000, seed=7)
+                watcher.process_run(1)
+                after = read_images(output_folder)
+            finally:
+                watcher.executor.shutdown()
+
+            jobs = enumerate_jobs(target_folder, DATE, 1, 1, 1, TRIALS, 0.1, 0.8)
+            render_batch(jobs, os.path.join(target_folder, MANIFEST_NAME), workers=1, force=True)
+            fresh = read_images(output_folder)
+
+            self.assertEqual(sorted(before), sorted(after))
+            self.assertTrue(all(before[name] != after[name] for name in before))
+            self.assertEqual(after, fresh)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,366 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')   # headless, must be selected before plot_graphs imports pyplot
+
+import numpy as np
+
+from figure_templates import TimelineTileTemplate
+from plot_graphs import FAST_PNG_COMPRESS_LEVEL, eye_trace, signal_event_data, trial_range_labels
+from session_events import load_session_events
+from session_paths import run_paths
+
+TILE_WIDTH_PX = 1024
+TILE_HEIGHT_PX = 400
+FINEST_MS_PER_PX = 2    # about the resolution of the 50 inch per trial signal graphs
+MANIFEST_NAME = 'timeline.json'
+VIEWER_NAME = 'index.html'
+
+_template = None
+
+
+def timeline_folder(output_folder, date, run_num):
+    return os.path.join(output_folder, "{}-run{}-timeline".format(date, run_num))
+
+
+def eye_trace_grid(events, trials, trial_start, start_ms, n_ms):
+    """The eye trace of the whole run on a 1 ms grid starting at start_ms, NaN where there is no sample."""
+    grid = np.full(n_ms, np.nan, dtype=np.float32)
+    for trial, start in zip(trials, trial_start):
+        x, y = eye_trace(events, trial, start)
+        x = x - start_ms
+        keep = (x >= 0) & (x < n_ms)
+        grid[x[keep]] = y[keep]
+    return grid
+
+
+def level_count(n_ms, finest_ms_per_px=FINEST_MS_PER_PX, tile_width=TILE_WIDTH_PX):
+    """Number of zoom levels so that level 0 fits the whole run in one tile and the last one is the finest."""
+    return 1 + max(0, math.ceil(math.log2(n_ms / (finest_ms_per_px * tile_width))))
+
+
+def reduce_pairs(values, size, ufunc):
+    """Reduces every group of size consecutive values with ufunc (np.fmin / np.fmax ignore NaN)."""
+    padded = np.full(-(-len(values) // size) * size, np.nan, dtype=values.dtype)
+    padded[:len(values)] = values
+    return ufunc.reduce(padded.reshape(-1, size), axis=1)
+
+
+def envelope_pyramid(grid, n_levels, finest_ms_per_px=FINEST_MS_PER_PX):
+    """
+    Min/max envelope of the eye trace per pixel column at every zoom level, level 0 (coarsest) first.
+
+    The finest level is reduced from the 1 ms grid, every coarser level from the level below it by pairs of
+    columns, so the whole pyramid costs about two passes over the run.
+    """
+    envelopes = [(reduce_pairs(grid, finest_ms_per_px, np.fmin), reduce_pairs(grid, finest_ms_per_px, np.fmax))]
+    for _ in range(n_levels - 1):
+        low, high = envelopes[-1]
+        envelopes.append((reduce_pairs(low, 2, np.fmin), reduce_pairs(high, 2, np.fmax)))
+    return envelopes[::-1]
+
+
+def render_tiles(tasks, event_data):
+    """Renders tiles in a worker process: [(png_name, x_limits, envelope_min, envelope_max)]."""
+    global _template
+    if _template is None:
+        _template = TimelineTileTemplate()
+    page = _template.figure((TILE_WIDTH_PX, TILE_HEIGHT_PX))
+    _template.set_events(page, event_data)
+    for png_name, x_limits, envelope_min, envelope_max in tasks:
+        _template.render(page, x_limits, envelope_min, envelope_max, png_name,
+                         {'compress_level': FAST_PNG_COMPRESS_LEVEL})
+    return len(tasks)
+
+
+def render_timeline(events, date, run_num, output_folder, first_trial=None, last_trial=None,
+                    finest_ms_per_px=FINEST_MS_PER_PX, workers=None):
+    """
+    Renders the whole run (or trials first_trial to last_trial) into a pyramid of tiles plus a local HTML viewer.
+
+    Level l has 2 ** l times the resolution of level 0, which shows the whole run in one tile. Returns the
+    folder of the timeline; open its index.html in a browser.
+    """
+    trials = [int(trial) for trial in events.trials if trial in events.eye_pos.trials
+              and (first_trial is None or trial >= first_trial) and (last_trial is None or trial <= last_trial)]
+    if not trials:
+        raise Exception("No trials to render!")
+    if trials != list(range(trials[0], trials[-1] + 1)):
+        raise Exception("Trials {} - {} are not consecutive!".format(trials[0], trials[-1]))
+
+    event_data = signal_event_data(trials, events)
+    # same margins as the signal graphs
+    start_ms = int(event_data['trial_start'][0]) - 500
+    end_ms = int(event_data['trial_end'][-1]) + 500
+    grid = eye_trace_grid(events, trials, event_data['trial_start'], start_ms, end_ms - start_ms)
+
+    n_levels = level_count(len(grid), finest_ms_per_px)
+    envelopes = envelope_pyramid(grid, n_levels, finest_ms_per_px)
+
+    folder = timeline_folder(output_folder, date, run_num)
+    tile_folder = os.path.join(folder, 'tiles')
+    shutil.rmtree(tile_folder, ignore_errors=True)   # tiles of an older, differently sized pyramid
+
+    levels = []
+    tasks = []
+    for level, (low, high) in enumerate(envelopes):
+        ms_per_px = finest_ms_per_px * 2 ** (n_levels - 1 - level)
+        n_tiles = -(-len(low) // TILE_WIDTH_PX)
+        levels.append({'level': level, 'ms_per_px': ms_per_px, 'tiles': n_tiles})
+        os.makedirs(os.path.join(tile_folder, str(level)))
+        for index in range(n_tiles):
+            columns = slice(index * TILE_WIDTH_PX, (index + 1) * TILE_WIDTH_PX)
+            tile_min = np.full(TILE_WIDTH_PX, np.nan, dtype=np.float32)
+            tile_max = np.full(TILE_WIDTH_PX, np.nan, dtype=np.float32)
+            tile_min[:len(low[columns])] = low[columns]
+            tile_max[:len(high[columns])] = high[columns]
+            tile_start = start_ms + index * TILE_WIDTH_PX * ms_per_px
+            tasks.append((os.path.join(tile_folder, str(level), '{}.png'.format(index)),
+                          (tile_start, tile_start + TILE_WIDTH_PX * ms_per_px), tile_min, tile_max))
+
+    if workers == 1:
+        render_tiles(tasks, event_data)
+    else:
+        n_chunks = 4 * (workers or os.cpu_count())
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(render_tiles, [tasks[i::n_chunks] for i in range(n_chunks)],
+                              [event_data] * n_chunks))
+
+    np.savez(os.path.join(folder, 'envelopes.npz'),
+             **{'{}_{}'.format(kind, level): envelope[i] for level, envelope in enumerate(envelopes)
+                for i, kind in enumerate(('min', 'max'))})
+
+    manifest = {
+        'title': "{} Run {} Signal Timeline for trial {}".format(
+            date, run_num, trial_range_labels(trials[0], trials[-1])[0]),
+        'tile_width': TILE_WIDTH_PX,
+        'tile_height': TILE_HEIGHT_PX,
+        'start_ms': start_ms,
+        'end_ms': end_ms,
+        'levels': levels,
+        'trials': [{'trial': trial, 'start': float(start), 'end': float(end)}
+                   for trial, start, end in zip(trials, event_data['trial_start'], event_data['trial_end'])],
+    }
+    with open(os.path.join(folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    write_viewer(os.path.join(folder, VIEWER_NAME), manifest)
+    return folder
+
+
+def write_viewer(path, manifest):
+    # the manifest is inlined, so the viewer also works from file:// where browsers block fetching local json
+    with open(path, 'w') as f:
+        f.write(VIEWER_HTML.replace('__TIMELINE__', json.dumps(manifest)))
+
+
+VIEWER_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Signal Timeline</title>
+<style>
+  body { font-family: sans-serif; margin: 16px; }
+  #controls { margin: 8px 0; }
+  #controls button, #controls select { margin-right: 6px; }
+  #frame { display: flex; }
+  #yaxis { position: relative; width: 70px; font-size: 12px; }
+  #yaxis span { position: absolute; right: 6px; transform: translateY(-50%); }
+  #viewport { position: relative; flex: 1; overflow: hidden; border: 1px solid #000; cursor: grab; background: #fff; }
+  #viewport img { position: absolute; top: 0; pointer-events: none; }
+  #xaxis { position: relative; margin-left: 71px; height: 20px; font-size: 12px; }
+  #xaxis span { position: absolute; transform: translateX(-50%); white-space: nowrap; }
+  #legend span { margin-right: 16px; }
+</style>
+</head>
+<body>
+<h3 id="title"></h3>
+<div id="controls">
+  <button id="zoom-in">+</button><button id="zoom-out">-</button><button id="whole-run">Whole run</button>
+  <select id="trial"><option value="">Go to trial...</option></select>
+  <span id="status"></span>
+</div>
+<div id="frame"><div id="yaxis"></div><div id="viewport"></div></div>
+<div id="xaxis"></div>
+<div style="text-align: center">Time (ms). Scroll to zoom, drag to pan.</div>
+<p id="legend">
+  <span style="color: purple">&#9632; Eye Position (Deg)</span><span style="color: red">- - Fixation at 1.5</span>
+  <span style="color: gray">&#9472; Baseline</span><span style="color: orange">&#9472; Stimulus</span>
+  <span>&#9474; Trial Start</span><span>&#9478; Trial End</span><span style="color: blue">&#9679; TTL</span>
+  <span style="color: green">&#9679; Reward</span><span style="color: red">&#9679; No Reward</span>
+</p>
+<script>
+const T = __TIMELINE__;
+const Y_MAX = 5.2;
+const viewport = document.getElementById('viewport');
+const tiles = new Map();
+const finest = T.levels[T.levels.length - 1];
+let left = T.start_ms;
+let msPerPx = 1;
+
+document.title = T.title;
+document.getElementById('title').textContent = T.title;
+viewport.style.height = T.tile_height + 'px';
+document.getElementById('yaxis').style.height = T.tile_height + 'px';
+
+const yTicks = [0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0];
+const yLabels = [0, 0.5, 1.0, 0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 3.5];
+for (let i = 0; i < yTicks.length; i++) {
+  const label = document.createElement('span');
+  label.textContent = yLabels[i].toFixed(1);
+  label.style.top = (T.tile_height * (1 - yTicks[i] / Y_MAX)) + 'px';
+  document.getElementById('yaxis').appendChild(label);
+}
+
+const trialSelect = document.getElementById('trial');
+for (const trial of T.trials) {
+  const option = document.createElement('option');
+  option.value = trial.trial;
+  option.textContent = 'Trial ' + trial.trial;
+  trialSelect.appendChild(option);
+}
+
+function chooseLevel() {
+  // the coarsest level that still has at least one tile pixel per screen pixel
+  for (const level of T.levels) {
+    if (level.ms_per_px <= msPerPx) return level;
+  }
+  return finest;
+}
+
+function clampView() {
+  const width = viewport.clientWidth;
+  msPerPx = Math.min(Math.max(msPerPx, finest.ms_per_px / 8), (T.end_ms - T.start_ms) / width);
+  left = Math.min(Math.max(left, T.start_ms), T.end_ms - width * msPerPx);
+}
+
+function drawAxis(width) {
+  const axis = document.getElementById('xaxis');
+  axis.innerHTML = '';
+  const raw = 120 * msPerPx;
+  const magnitude = Math.pow(10, Math.floor(Math.log10(raw)));
+  const step = [1, 2, 5, 10].map(f => f * magnitude).find(s => s >= raw);
+  for (let t = Math.ceil(left / step) * step; t <= left + width * msPerPx; t += step) {
+    const label = document.createElement('span');
+    label.textContent = Math.round(t);
+    label.style.left = ((t - left) / msPerPx) + 'px';
+    axis.appendChild(label);
+  }
+}
+
+function update() {
+  clampView();
+  const width = viewport.clientWidth;
+  const level = chooseLevel();
+  const tileMs = level.ms_per_px * T.tile_width;
+  const first = Math.max(0, Math.floor((left - T.start_ms) / tileMs));
+  const last = Math.min(level.tiles - 1, Math.floor((left + width * msPerPx - T.start_ms) / tileMs));
+  const wanted = new Set();
+  // only the tiles in view are loaded; the browser cache makes revisiting them cheap
+  for (let i = first; i <= last; i++) {
+    const key = level.level + '/' + i;
+    wanted.add(key);
+    let img = tiles.get(key);
+    if (!img) {
+      img = document.createElement('img');
+      img.src = 'tiles/' + key + '.png';
+      img.draggable = false;
+      viewport.appendChild(img);
+      tiles.set(key, img);
+    }
+    img.style.left = ((T.start_ms + i * tileMs - left) / msPerPx) + 'px';
+    img.style.width = (tileMs / msPerPx) + 'px';
+    img.style.height = T.tile_height + 'px';
+  }
+  for (const [key, img] of tiles) {
+    if (!wanted.has(key)) {
+      img.remove();
+      tiles.delete(key);
+    }
+  }
+  document.getElementById('status').textContent =
+    'zoom level ' + level.level + ' of ' + (T.levels.length - 1) + ', ' + msPerPx.toFixed(2) + ' ms per pixel';
+  drawAxis(width);
+}
+
+function zoom(factor, x) {
+  const t = left + x * msPerPx;
+  msPerPx *= factor;
+  clampView();
+  left = t - x * msPerPx;
+  update();
+}
+
+function showRange(start, end) {
+  msPerPx = (end - start) / viewport.clientWidth;
+  left = start;
+  update();
+}
+
+viewport.addEventListener('wheel', e => {
+  e.preventDefault();
+  zoom(Math.exp(e.deltaY * 0.002), e.clientX - viewport.getBoundingClientRect().left);
+}, {passive: false});
+
+let drag = null;
+viewport.addEventListener('mousedown', e => {
+  drag = {x: e.clientX, left: left};
+  viewport.style.cursor = 'grabbing';
+});
+window.addEventListener('mousemove', e => {
+  if (drag) {
+    left = drag.left - (e.clientX - drag.x) * msPerPx;
+    update();
+  }
+});
+window.addEventListener('mouseup', () => {
+  drag = null;
+  viewport.style.cursor = 'grab';
+});
+window.addEventListener('keydown', e => {
+  const width = viewport.clientWidth;
+  if (e.key === 'ArrowLeft') { left -= width * msPerPx / 4; update(); }
+  if (e.key === 'ArrowRight') { left += width * msPerPx / 4; update(); }
+  if (e.key === '+' || e.key === '=') zoom(0.5, width / 2);
+  if (e.key === '-') zoom(2, width / 2);
+});
+window.addEventListener('resize', update);
+document.getElementById('zoom-in').onclick = () => zoom(0.5, viewport.clientWidth / 2);
+document.getElementById('zoom-out').onclick = () => zoom(2, viewport.clientWidth / 2);
+document.getElementById('whole-run').onclick = () => showRange(T.start_ms, T.end_ms);
+trialSelect.onchange = () => {
+  const trial = T.trials.find(t => String(t.trial) === trialSelect.value);
+  if (trial) showRange(trial.start - 500, trial.end + 500);
+};
+
+showRange(T.start_ms, T.end_ms);
+</script>
+</body>
+</html>
+"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Render whole runs into zoomable timeline tiles with an HTML viewer.")
+    parser.add_argument('target_folder', help="the session folder that contains the csv folder and output folders")
+    parser.add_argument('date', help="date of the session, e.g. 2025-07-10")
+    parser.add_argument('--runs', type=int, nargs=2, required=True, metavar=('FIRST', 'LAST'))
+    parser.add_argument('--trials', type=int, nargs=2, default=(None, None), metavar=('FIRST', 'LAST'),
+                        help="only these trials (default: the whole run)")
+    parser.add_argument('--ms-per-px', type=int, default=FINEST_MS_PER_PX,
+                        help="milliseconds per pixel at the finest zoom level")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    for run in range(args.runs[0], args.runs[1] + 1):
+        filepath_signal, filepath_eyepos, output_image_folder = run_paths(args.target_folder, run)
+        start = time.perf_counter()
+        run_events = load_session_events(filepath_signal, filepath_eyepos)
+        timeline = render_timeline(run_events, args.date, run, output_image_folder, args.trials[0], args.trials[1],
+                                   args.ms_per_px, args.workers)
+        print("run {}: {:.1f}s, open {}".format(run, time.perf_counter() - start, os.path.join(timeline, VIEWER_NAME)))
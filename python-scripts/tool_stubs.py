@@ -0,0 +1,60 @@
+"""
+Stand-ins for dcm2niix, fslsplit, bet, fslmerge and tcsh, so pipeline_runner.py can be tested without the real tools.
+
+They handle little-endian NIfTI-1 files only and do no processing: bet copies its input, dcm2niix copies the .nii files
+of the "dicom" folder. Usage: python tool_stubs.py <tool> <the tool's arguments>
+"""
+import gzip
+import os
+import shutil
+import struct
+import sys
+
+
+def read_nifti(path):
+    """Returns (header, dim, volume size in bytes, data) of a NIfTI-1 file."""
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        content = f.read()
+    dim = list(struct.unpack('<8h', content[40:56]))
+    bitpix = struct.unpack('<h', content[72:74])[0]
+    offset = int(struct.unpack('<f', content[108:112])[0])
+    volume = dim[1] * dim[2] * dim[3] * bitpix // 8
+    return bytearray(content[:offset]), dim, volume, content[offset:]
+
+
+def write_nifti(path, header, dim, data):
+    header[40:56] = struct.pack('<8h', *dim)
+    if not path.endswith('.nii') and not path.endswith('.nii.gz'):
+        path += '.nii.gz'
+    with (gzip.open if path.endswith('.gz') else open)(path, 'wb') as f:
+        f.write(bytes(header) + data)
+
+
+def stub(tool, args):
+    if tool == 'dcm2niix':
+        # copies the .nii files of the input folder, which stands in for the dicom folder
+        output, source = args[args.index('-o') + 1], args[-1]
+        os.makedirs(output, exist_ok=True)
+        for name in os.listdir(source):
+            if name.endswith('.nii') or name.endswith('.nii.gz'):
+                shutil.copy(os.path.join(source, name), output)
+    elif tool == 'fslsplit':
+        header, dim, volume, data = read_nifti(args[0])
+        for i in range(max(dim[4], 1)):
+            write_nifti('{}{:04d}.nii.gz'.format(args[1], i), header, dim[:4] + [1] + dim[5:],
+                        data[i * volume:(i + 1) * volume])
+    elif tool == 'bet':
+        header, dim, volume, data = read_nifti(args[0])
+        write_nifti(args[1], header, dim, data)
+    elif tool == 'fslmerge':
+        frames = [read_nifti(frame) for frame in args[2:]]
+        header, dim, _, _ = frames[0]
+        write_nifti(args[1], header, dim[:4] + [len(frames)] + dim[5:], b''.join(frame[3] for frame in frames))
+    elif tool == 'tcsh':
+        print("stub: tcsh {}".format(' '.join(args)))
+    else:
+        raise Exception("No stub for {}!".format(tool))
+
+
+if __name__ == '__main__':
+    stub(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,164 @@
+import argparse
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')   # headless, must be selected before plot_graphs imports pyplot
+
+from batch_render import MANIFEST_NAME, enumerate_jobs, render_batch
+from eyepos_censor import write_censor_1Dfile
+from eyepos_io import load_eyepos
+from session_censor import run_censor
+from session_paths import run_csv_files, run_paths
+
+POLL_INTERVAL = 0.5     # seconds between scans of the csv folder
+DEBOUNCE = 2.0          # seconds a csv must stay unchanged before its run is processed
+
+
+class CsvWatcher:
+    """
+    Polls the csv folder of a session and reports a run once both of its csv files exist and neither has changed
+    for debounce seconds, so a run MATLAB is still writing is not read half way.
+    """
+
+    def __init__(self, target_folder, debounce=DEBOUNCE):
+        self.target_folder = target_folder
+        self.debounce = debounce
+        self.seen = {}      # run: the file states last reported
+        self.changed = {}   # run: (file states, time they were first seen)
+
+    def poll(self):
+        """Returns the runs that changed and have settled since the last call."""
+        now = time.monotonic()
+        ready = []
+        for run, files in sorted(run_csv_files(self.target_folder).items()):
+            if len(files) < 2 or files == self.seen.get(run):
+                self.changed.pop(run, None)
+                continue
+            if run not in self.changed or self.changed[run][0] != files:
+                self.changed[run] = (files, now)
+            elif now - self.changed[run][1] >= self.debounce:
+                del self.changed[run]
+                self.seen[run] = files
+                ready.append(run)
+        return ready
+
+
+def ignore_interrupt():
+    # Ctrl+C reaches the workers too; only the watcher handles it, and shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def warm_up(_):
+    # started up front, so the first change does not wait for the workers to start
+    return os.getpid()
+
+
+class SessionWatcher:
+    """
+    Keeps a worker pool with everything imported and regenerates the signal graphs, heatmaps and censor file of a
+    run when its csv files change. Runs are processed one at a time, in the order they changed; the images of a
+    run are rendered on the whole pool, and images whose inputs did not change are skipped (see batch_render.py).
+    """
+
+    def __init__(self, target_folder, date, tile_size=0.1, rad=0.8, fast=False, censor=None, workers=None,
+                 debounce=DEBOUNCE):
+        self.target_folder = target_folder
+        self.date = date
+        self.tile_size = tile_size
+        self.rad = rad
+        self.fast = fast
+        self.censor = censor    # keyword arguments of run_censor, or None for no censor file
+        self.watcher = CsvWatcher(target_folder, debounce)
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=ignore_interrupt)
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        list(self.executor.map(warm_up, range(workers or os.cpu_count())))
+
+    def submit(self, run):
+        with self.lock:
+            if run in self.queued:
+                return
+            self.queued.add(run)
+        self.queue.put(run)
+
+    def work(self):
+        while True:
+            run = self.queue.get()
+            if run is None:
+                return
+            with self.lock:
+                self.queued.discard(run)
+            try:
+                self.process_run(run)
+            except Exception:
+                print("run {} FAILED\n{}".format(run, traceback.format_exc()), flush=True)
+
+    def process_run(self, run):
+        start = time.perf_counter()
+        filepath_signal, filepath_eyepos, output_folder = run_paths(self.target_folder, run)
+        trials = load_eyepos(filepath_eyepos).trials
+        jobs = enumerate_jobs(self.target_folder, self.date, run, run, trials[0], trials[-1], self.tile_size,
+                              self.rad, fast=self.fast)
+        report = render_batch(jobs, os.path.join(self.target_folder, MANIFEST_NAME), executor=self.executor)
+        counts = {status: sum(1 for r in report if r[1] == status) for status in ('done', 'skipped', 'failed')}
+        message = "{done} rendered, {skipped} up to date, {failed} failed".format(**counts)
+
+        if self.censor is not None:
+            os.makedirs(output_folder, exist_ok=True)
+            censor_file = os.path.join(output_folder, os.path.splitext(os.path.basename(filepath_eyepos))[0] + '.1D')
+            write_censor_1Dfile(censor_file, [self.executor.submit(run_censor, filepath_eyepos,
+                                                                   **self.censor).result()])
+            message += ", censor written"
+        print("run {}: {} ({:.1f}s)".format(run, message, time.perf_counter() - start), flush=True)
+
+    def watch(self, poll_interval=POLL_INTERVAL):
+        """Processes every run once (up to date images are skipped), then every run that changes, until Ctrl+C."""
+        worker = threading.Thread(target=self.work, daemon=True)
+        worker.start()
+        print("watching {}".format(os.path.join(self.target_folder, 'csv')), flush=True)
+        try:
+            while True:
+                for run in self.watcher.poll():
+                    self.submit(run)
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.queue.put(None)
+            worker.join()
+            self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Regenerate the graphs and censor file of a run whenever its csv "
+                                                 "files change.")
+    parser.add_argument('target_folder', help="the session folder that contains the csv folder and output folders")
+    parser.add_argument('date', help="date of the session, e.g. 2025-07-10")
+    parser.add_argument('--tile-size', type=float, default=0.1, help="the tile size in the heatmap")
+    parser.add_argument('--rad', type=float, default=0.8, help="fixation radius, the dotted circle in the heatmap")
+    parser.add_argument('--fast', action='store_true', help="fast rendering mode for the signal graphs")
+    parser.add_argument('--method', choices=['mean', 'percentage'], default=None,
+                        help="also write the censor file of every run with this method")
+    parser.add_argument('--mean-threshold', type=float)
+    parser.add_argument('--std-dev-threshold', type=float)
+    parser.add_argument('--fixation', type=float)
+    parser.add_argument('--percent-threshold', type=float)
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: all cores)")
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE,
+                        help="seconds a csv must stay unchanged before it is read")
+    args = parser.parse_args()
+
+    censor_params = None
+    if args.method is not None:
+        censor_params = {'method': args.method, 'mean_threshold': args.mean_threshold,
+                         'std_dev_threshold': args.std_dev_threshold, 'fixation': args.fixation,
+                         'percent_threshold': args.percent_threshold}
+    SessionWatcher(args.target_folder, args.date, args.tile_size, args.rad, args.fast, censor_params, args.workers,
+                   args.debounce).watch()